@@ -1,4 +1,8 @@
+from cube.books.models import get_version, bump_version
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from threading import Lock
+from time import time
 
 class AppSetting(models.Model):
     name = models.CharField(max_length=200)
@@ -7,3 +11,75 @@ class AppSetting(models.Model):
 
     def __unicode__(self):
         return self.name
+
+# Name of the DataVersion bumped whenever a setting is saved
+SETTINGS_VERSION = 'appsettings'
+
+# What a setting reads as when nobody has created it yet
+DEFAULTS = {
+    'Money Collection Hours' : '',
+}
+
+class SettingsCache(object):
+    """
+    Every setting's value, loaded with one query and kept until the
+    settings version changes. The version is only looked at every
+    check_seconds, so most reads don't touch the database at all
+    """
+    def __init__(self, check_seconds=10):
+        self.check_seconds = check_seconds
+        self.values = None
+        self.version = None
+        self.checked = 0
+        self.lock = Lock()
+
+    def load(self, version):
+        values = {}
+        # the oldest setting wins if a name is used twice
+        for name, value in AppSetting.objects.order_by('-id')\
+                                             .values_list('name', 'value'):
+            values[name] = value
+        self.lock.acquire()
+        try:
+            self.values = values
+            self.version = version
+        finally:
+            self.lock.release()
+        return values
+
+    def get(self, name):
+        now = time()
+        values = self.values
+        if values is None or now - self.checked > self.check_seconds:
+            self.checked = now
+            version = get_version(SETTINGS_VERSION)
+            if values is None or version != self.version:
+                values = self.load(version)
+        return values.get(name)
+
+    def clear(self):
+        self.values = None
+
+# Shared by every request this process serves
+cache = SettingsCache()
+
+def get_setting(name, default=None, cast=unicode):
+    """
+    Returns the value of the setting called name converted with cast.
+    Settings that don't exist, or can't be converted, give default,
+    or the value in DEFAULTS if no default is passed
+    """
+    if default is None: default = DEFAULTS.get(name)
+    value = cache.get(name)
+    if value is None: return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+def settings_changed(sender, **kwargs):
+    # this process reloads straight away, the others on their next check
+    cache.clear()
+    bump_version(SETTINGS_VERSION)
+post_save.connect(settings_changed, sender=AppSetting)
+post_delete.connect(settings_changed, sender=AppSetting)
@@ -21,3 +21,46 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from cube.appsettings.models import AppSetting, SETTINGS_VERSION, cache,\
+                                    get_setting
+from cube.books.models import bump_version
+from django.conf import settings
+from django.db import connection
+
+class SettingsCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.old_debug = settings.DEBUG
+        # queries are only recorded while DEBUG is on
+        settings.DEBUG = True
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+    def test_defaults(self):
+        """ Missing settings read as their default instead of crashing """
+        self.assertEquals(get_setting("Money Collection Hours"), '')
+        self.assertEquals(get_setting("Nothing", 5, int), 5)
+    def test_cached(self):
+        """ Once loaded, reading settings doesn't query the database """
+        AppSetting(name="Max", value="12", description="").save()
+        self.assertEquals(get_setting("Max", cast=int), 12)
+        connection.queries = []
+        self.assertEquals(get_setting("Max", cast=int), 12)
+        self.assertEquals(len(connection.queries), 0)
+    def test_saved(self):
+        """ Saving a setting is seen straight away """
+        setting = AppSetting(name="Max", value="12", description="")
+        setting.save()
+        get_setting("Max")
+        setting.value = "13"
+        setting.save()
+        self.assertEquals(get_setting("Max"), "13")
+    def test_other_process(self):
+        """ A change made elsewhere is seen on the next version check """
+        setting = AppSetting(name="Max", value="12", description="")
+        setting.save()
+        get_setting("Max")
+        AppSetting.objects.filter(pk=setting.pk).update(value="14")
+        bump_version(SETTINGS_VERSION)
+        cache.checked = 0
+        self.assertEquals(get_setting("Max"), "14")
@@ -6,8 +6,7 @@ from cube.books.models import MetaBook, Course, Book, Log
 from cube.appsettings.forms import SettingForm
 from cube.books.forms import NewBookForm, BookForm, FilterForm 
 from cube.books.views.tools import book_filter,\
-                                  book_sort, get_number, tidy_error,\
-                                  house_cleaning
+                                  book_sort, get_number, tidy_error
 from cube.twupass.tools import import_user
 from cube.books.email import send_missing_emails, send_sold_emails,\
                              send_tbd_emails
@@ -36,7 +35,6 @@ def setting_list(request):
     
     Tests:
     """
-    house_cleaning()
     # Filter for the search box
     if request.method == 'GET':
         filter_form = FilterForm(request.GET)
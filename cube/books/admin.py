@@ -1,9 +1,33 @@
 # Copyright (C) 2010  Trinity Western University
 
 from cube.books.models import MetaBook, Book, Course, Log
+from django import forms
 from django.contrib import admin
 
-admin.site.register(MetaBook)
+class MetaBookAdminForm(forms.ModelForm):
+    class Meta:
+        model = MetaBook
+
+    def save(self, commit=True):
+        """
+        Stores the course list once the courses have been saved, which
+        the admin does after saving the metabook
+        """
+        metabook = super(MetaBookAdminForm, self).save(commit)
+        if commit:
+            metabook.update_course_list()
+        else:
+            save_m2m = self.save_m2m
+            def save_courses():
+                save_m2m()
+                metabook.update_course_list()
+            self.save_m2m = save_courses
+        return metabook
+
+class MetaBookAdmin(admin.ModelAdmin):
+    form = MetaBookAdminForm
+
+admin.site.register(MetaBook, MetaBookAdmin)
 admin.site.register(Book)
 admin.site.register(Course)
 admin.site.register(Log)
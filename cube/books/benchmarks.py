@@ -0,0 +1,179 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+Benchmarks for the slow parts of the site. Run them with
+    ./manage.py benchmark <name> [--size N]
+They are run against a throw-away test database, never the real one.
+"""
+
+from cube.books.models import Book, MetaBook, Course, DEPARTMENT_CHOICES
+from cube.books import search
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from datetime import datetime
+from decimal import Decimal
+from random import Random
+from time import time
+
+# name -> (function, default size)
+BENCHMARKS = {}
+
+def benchmark(name, default_size):
+    """
+    Registers a function as a benchmark. The function takes the size of the
+    dataset to build and returns a list of (label, seconds) results
+    """
+    def register(func):
+        BENCHMARKS[name] = (func, default_size)
+        return func
+    return register
+
+def timed(func, repeat=5):
+    """
+    Returns the best time in seconds of repeat calls to func
+    """
+    best = None
+    for i in range(repeat):
+        start = time()
+        func()
+        taken = time() - start
+        if best is None or taken < best: best = taken
+    return best
+
+def bulk_insert(model, fields, rows):
+    """
+    Inserts rows (tuples of values for fields) straight into the table of
+    model. Used to build big datasets quickly
+    """
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(f).column for f in fields]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ', '.join([qn(c) for c in columns]),
+        ', '.join(['%s'] * len(columns)))
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+WORDS = ('introduction', 'principles', 'theology', 'history', 'modern',
+         'biology', 'calculus', 'ethics', 'church', 'world', 'american',
+         'analysis', 'writing', 'psychology', 'business', 'ancient')
+NAMES = ('Smith', 'Barth', 'Tolkien', 'Lewis', 'Stewart', 'Nguyen',
+         'Campbell', 'Wright', 'Fee', 'Grudem', 'Noll', 'Keller')
+
+def populate(num_books, seed=42):
+    """
+    Fills the database with num_books books spread over one fifth as many
+    metabooks, one twentieth as many sellers and a couple hundred courses
+    """
+    rand = Random(seed)
+    now = datetime.now()
+    num_users = max(num_books // 20, 1)
+    num_metabooks = max(num_books // 5, 1)
+    user_fields = ('username', 'first_name', 'last_name', 'email',
+                   'password', 'is_staff', 'is_active', 'is_superuser',
+                   'last_login', 'date_joined')
+    bulk_insert(User, user_fields, [
+        ('bench%d' % i, 'Bench', rand.choice(NAMES),
+         'bench%d@example.com' % i, '!', False, True, False, now, now)
+        for i in range(num_users)])
+    user_ids = list(User.objects.filter(username__startswith='bench')
+                                .values_list('id', flat=True))
+    departments = [d[0] for d in DEPARTMENT_CHOICES]
+    for i in range(200):
+        Course.objects.get_or_create(department=rand.choice(departments),
+                                     number=str(100 + i))
+    course_ids = list(Course.objects.values_list('id', flat=True))
+
+    rows = []
+    for i in range(num_metabooks):
+        title = ' '.join([rand.choice(WORDS).title() for w in range(4)])
+        rows.append((title, rand.choice(NAMES), '97800%08d' % i, 1))
+    bulk_insert(MetaBook, ('title', 'author', 'barcode', 'edition'), rows)
+    metabook_ids = list(MetaBook.objects.values_list('id', flat=True))
+    qn = connection.ops.quote_name
+    m2m = MetaBook._meta.get_field('courses')
+    sql = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+        qn(m2m.m2m_db_table()), qn(m2m.m2m_column_name()),
+        qn(m2m.m2m_reverse_name()))
+    connection.cursor().executemany(sql,
+        [(m, rand.choice(course_ids)) for m in metabook_ids])
+    search.rebuild_index()
+
+    statuses = 'FFFFFFOSSPPDDTM'
+    rows = []
+    for i in range(num_books):
+        rows.append((rand.choice(metabook_ids),
+                     rand.choice(user_ids),
+                     now, Decimal(rand.randrange(100, 10000)) / 100,
+                     rand.choice(statuses), False))
+        if len(rows) >= 5000:
+            bulk_insert(Book, ('metabook', 'seller', 'list_date', 'price',
+                               'status', 'is_legacy'), rows)
+            rows = []
+    bulk_insert(Book, ('metabook', 'seller', 'list_date', 'price',
+                       'status', 'is_legacy'), rows)
+    return rand
+
+@benchmark('search', 100000)
+def bench_search(size):
+    """
+    The book list "any field" search, with and without the search index
+    """
+    from cube.books.views.tools import book_filter
+    populate(size)
+    results = []
+    for filter in ('theology', 'Tolkien', '9780000012', 'BIOL 101', 'hist'):
+        def scan():
+            list(book_filter(filter, 'any_field', Book.objects.all(),
+                             indexed=False).values_list('id', flat=True))
+        def indexed():
+            list(book_filter(filter, 'any_field', Book.objects.all())
+                 .values_list('id', flat=True))
+        results.append(('"%s" scan' % filter, timed(scan)))
+        results.append(('"%s" indexed' % filter, timed(indexed)))
+    return results
+
+@benchmark('suggest', 50000)
+def bench_suggest(size):
+    """
+    Search box suggestions with size metabooks in the prefix index
+    """
+    rand = Random(42)
+    rows = []
+    for i in range(size):
+        title = ' '.join([rand.choice(WORDS).title() for w in range(4)])
+        rows.append((title, rand.choice(NAMES), '97800%08d' % i, 1))
+    bulk_insert(MetaBook, ('title', 'author', 'barcode', 'edition'), rows)
+    results = [('build', timed(search.prefixes.build, repeat=1))]
+    search.prefixes.version = search.get_version(search.METABOOKS_VERSION)
+    for prefix in ('t', 'theo', 'modern hist', 'tolk', '9780001'):
+        results.append(('"%s"' % prefix,
+                        timed(lambda: search.suggest(prefix))))
+    return results
+
+@benchmark('expire_holds', 20000)
+def bench_expire_holds(size):
+    """
+    Expiring size holds at once, half of which have run out
+    """
+    from cube.books.views.tools import expire_holds
+    from datetime import timedelta
+    populate(size * 2)
+    # put size of the books on hold, half of them from two days ago
+    ids = list(Book.objects.values_list('id', flat=True)[:size])
+    user_ids = list(User.objects.values_list('id', flat=True))
+    rand = Random(7)
+    qn = connection.ops.quote_name
+    sql = "UPDATE %s SET %s = 'O', %s = %%s, %s = %%s WHERE %s = %%s" % (
+        qn(Book._meta.db_table), qn('status'), qn('holder_id'),
+        qn('hold_date'), qn('id'))
+    now = datetime.now()
+    connection.cursor().executemany(sql, [
+        (rand.choice(user_ids), now - timedelta(days=2 * (i % 2)), id)
+        for i, id in enumerate(ids)])
+    transaction.commit_unless_managed()
+    results = [('expire %d of %d holds' % (size // 2, size),
+                timed(expire_holds, repeat=1))]
+    # the second run has nothing left to do
+    results.append(('run with nothing due', timed(expire_holds)))
+    return results
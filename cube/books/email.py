@@ -1,10 +1,16 @@
 # Copyright (C) 2010  Trinity Western University
 
 from cube.settings import DEBUG, ADMINS as admin_emails
-from cube.books.models import Book
-from cube.appsettings.models import AppSetting
+from cube.books.models import Book, SellerNotice, get_counter,\
+                              increment_counter
+from cube.books.outbox import queue_email
+from cube.appsettings.models import get_setting
+from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
 from django.template import loader, Context
+from datetime import datetime
 from re import sub
 
 def strip_html(value):
@@ -12,16 +18,38 @@ def strip_html(value):
     return sub(r'<[^>]*?>', '', value)
 
 def index_by_owner(books):
+    """
+    Returns a list of (owner, their books), with every book's metabook and
+    seller loaded by one query
+    """
+    if isinstance(books, QuerySet):
+        books = books.select_related('metabook', 'seller')
+    owners = {}
     items = {}
     for book in books:
-        if items.has_key(book.seller):
-            items[book.seller].append(book)
-        else:
-            items[book.seller] = [book]
-    return items
+        owners[book.seller_id] = book.seller
+        items.setdefault(book.seller_id, []).append(book)
+    return [(owners[id], items[id]) for id in items]
 
-def create_context(owner, books):
+def owner_contexts(books):
+    """
+    Builds the email context for every owner of books. The query count
+    is the same however many owners there are: one for the books, one for
+    what the owners still have for sale and one for the custom message.
+    Returns a list of (owner, context)
+    """
+    by_owner = index_by_owner(books)
+    if not by_owner: return []
+    owner_ids = [owner.id for owner, books in by_owner]
+    selling = {}
+    for book in Book.objects.filter(seller__in=owner_ids, status='F'):
+        selling.setdefault(book.seller_id, []).append(book)
     custom_msg = get_setting_message()
+    return [(owner, create_context(owner, books, custom_msg,
+                                   selling.get(owner.id, [])))
+            for owner, books in by_owner]
+
+def create_context(owner, books, custom_msg, owner_selling):
     if not len(custom_msg) > 1:
         custom_msg = ''
     return Context({
@@ -29,7 +57,7 @@ def create_context(owner, books):
         'name' : owner.first_name,
         'num_books' : len(books),
         'book_titles' : map(lambda x: x.metabook.title, books),
-        'owner_selling' : Book.objects.filter(seller=owner, status='F'),
+        'owner_selling' : owner_selling,
         'admin_email' : admin_emails[0][1],
     })
 
@@ -47,51 +75,138 @@ def create_email(subj, html_content, owner):
     msg.attach_alternative(html_content, "text/html")
     return msg
 
+def missing_subject(num_books):
+    if num_books == 1: p = ''
+    else: p = 's'
+    return 'Your book%s went missing at the Cube' % p
+
+def sold_subject(num_books):
+    if num_books == 1: p = ' has'
+    else: p = 's have'
+    return 'Your book%s been sold at the Cube' % p
+
+def tbd_subject(num_books):
+    if num_books == 1: p = ' was'
+    else: p = 's were'
+    return 'Your book%s not sold at the Cube' % p
+
+# The kinds of SellerNotice with the template and subject of their emails
+# and the template of their section of a digest
+NOTICES = {
+    'S' : ('email/sold.html', sold_subject, 'email/sold_section.html'),
+    'M' : ('email/missing.html', missing_subject, 'email/missing_section.html'),
+    'T' : ('email/to_be_deleted.html', tbd_subject,
+           'email/to_be_deleted_section.html'),
+}
+
+# Counters of how many emails would have gone out without the digest
+# and how many digests went out instead
+DIGEST_NOTICES = 'digest_notices'
+DIGEST_EMAILS = 'digest_emails'
+
+def digest_mode():
+    return getattr(settings, 'EMAIL_DIGEST', False)
+
+def send_notices(kind, books):
+    """
+    Queues an email of the given kind to each owner of books, or saves
+    them for the next digest if EMAIL_DIGEST is on
+    """
+    if digest_mode():
+        return save_notices(kind, books)
+    template, subject, section = NOTICES[kind]
+    t = loader.get_template(template)
+    for owner, c in owner_contexts(books):
+        msg = create_email(subject(c['num_books']), t.render(c), owner)
+        queue_email(msg)
+
+def save_notices(kind, books):
+    """
+    books can be a queryset or a list, like for index_by_owner
+    """
+    if isinstance(books, QuerySet):
+        books = list(books.values_list('id', 'seller'))
+    else:
+        books = [(book.id, book.seller_id) for book in books]
+    if not books: return
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)" % (
+        qn(SellerNotice._meta.db_table), qn('kind'), qn('book_id'),
+        qn('seller_id'), qn('created'))
+    now = datetime.now()
+    connection.cursor().executemany(sql,
+        [(kind, book_id, seller_id, now) for book_id, seller_id in books])
+    # each of these owners would have had an email of their own
+    increment_counter(DIGEST_NOTICES, len(set([row[1] for row in books])))
+
 def send_missing_emails(books):
     """
-    Sends an email to the owners of books which have gone missing
+    Queues an email to the owners of books which have gone missing
     Tests: EmailTest
     """
-    t = loader.get_template('email/missing.html')
-    missing = index_by_owner(books)
-    for owner, books in missing.items():
-        c = create_context(owner, books)
-        if len(books) == 1: p = ''
-        else: p = 's'
-        subj = 'Your book%s went missing at the Cube' % p
-        msg = create_email(subj, t.render(c), owner)
-        msg.send()
+    send_notices('M', books)
 
 def send_sold_emails(books):
     """
-    Sends an email to the owners of books which have been sold
+    Queues an email to the owners of books which have been sold
     Tests: EmailTest
     """
-    t = loader.get_template('email/sold.html')
-    sold = index_by_owner(books)
-    for owner, books in sold.items():
-        c = create_context(owner, books)
-        if len(books) == 1: p = ' has'
-        else: p = 's have'
-        subj = 'Your book%s been sold at the Cube' % p
-        msg = create_email(subj, t.render(c), owner)
-        msg.send()
+    send_notices('S', books)
 
 def send_tbd_emails(books):
     """
-    Sends an email to the owners of books which have been
+    Queues an email to the owners of books which have been
     marked as 'To Be Deleted'
     Tests: EmailTest
     """
-    t = loader.get_template('email/to_be_deleted.html')
-    to_be_deleted = index_by_owner(books)
-    for owner, books in to_be_deleted.items():
-        c = create_context(owner, books)
-        if len(books) == 1: p = ' was'
-        else: p = 's were'
-        subj = 'Your book%s not sold at the Cube' % p
-        msg = create_email(subj, t.render(c), owner)
-        msg.send()
+    send_notices('T', books)
+
+def send_digests():
+    """
+    Queues one email per seller covering everything saved up for them
+    since the last digest. Each kind gets its own section in between a
+    single greeting and signature.
+    Returns the number of emails queued
+    """
+    last = SellerNotice.objects.order_by('-id').values_list('id', flat=True)
+    last = list(last[:1])
+    if not last: return 0
+    notices = SellerNotice.objects.filter(id__lte=last[0])
+    sections = {}
+    owners = {}
+    for kind in ('S', 'M', 'T'):
+        book_ids = notices.filter(kind=kind).values_list('book', flat=True)
+        book_ids = list(book_ids)
+        if not book_ids: continue
+        template, subject, section = NOTICES[kind]
+        t = loader.get_template(section)
+        books = Book.objects.filter(id__in=book_ids)
+        for owner, c in owner_contexts(books):
+            # the rest of the context is the same for every kind
+            owners[owner.id] = (owner, c)
+            sections.setdefault(owner.id, []).append(
+                (kind, subject(c['num_books']), t.render(c)))
+    t = loader.get_template('email/digest.html')
+    for owner_id, owner_sections in sections.items():
+        owner, c = owners[owner_id]
+        if len(owner_sections) == 1: subj = owner_sections[0][1]
+        else: subj = 'News about your books at the Cube'
+        kinds = [section[0] for section in owner_sections]
+        c.update({
+            'sections' : [section[2] for section in owner_sections],
+            'sold' : 'S' in kinds,
+        })
+        queue_email(create_email(subj, t.render(c), owner))
+    notices.delete()
+    increment_counter(DIGEST_EMAILS, len(sections))
+    return len(sections)
+send_digests = transaction.commit_on_success(send_digests)
+
+def digest_savings():
+    """
+    How many emails the digest has saved so far
+    """
+    return get_counter(DIGEST_NOTICES) - get_counter(DIGEST_EMAILS)
 
 def get_setting_message():
     """
@@ -99,6 +214,4 @@ def get_setting_message():
     static message for insertion into emails. Staff/Administrators
     can define this message at anytime through the settings page.
     """
-
-    message_setting = AppSetting.objects.filter(name="Money Collection Hours")[0]
-    return message_setting.value
+    return get_setting("Money Collection Hours")
@@ -0,0 +1,45 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+Reports as downloadable spreadsheets. The response is built by a
+generator so rows are sent as they are read instead of all at once
+"""
+
+from django.http import HttpResponse
+from cStringIO import StringIO
+import csv
+
+# format -> (csv dialect, mimetype, file extension)
+FORMATS = {
+    'csv' : (csv.excel, 'text/csv', 'csv'),
+    'tsv' : (csv.excel_tab, 'text/tab-separated-values', 'tsv'),
+}
+
+def cell(value):
+    if value is None: return ''
+    return unicode(value).encode('utf-8')
+
+def lines(header, rows, dialect):
+    """
+    Yields the file a row at a time
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, dialect)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([cell(value) for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def export_response(header, rows, format, filename):
+    """
+    Returns a response which streams rows (any iterable of sequences)
+    under header as a CSV or TSV file called filename
+    """
+    dialect, mimetype, extension = FORMATS[format]
+    response = HttpResponse(lines(header, rows, dialect), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+        filename, extension)
+    return response
@@ -3,6 +3,7 @@
 from datetime import date
 
 from cube.books.models import MetaBook, Course, Book, DEPARTMENT_CHOICES
+from cube.books.isbn import canonical_barcode, clean, InvalidISBN
 from django import forms
 from django.core.exceptions import ValidationError
 from decimal import Decimal
@@ -15,6 +16,20 @@ class CourseNumberField(forms.IntegerField):
         if len(str(value)) > 3:
             raise ValidationError("The Course Number %d is too long" % value)
 
+def clean_barcode(barcode):
+    """
+    Stores ISBN-10s as ISBN-13s so both find the same book.
+    A barcode with a wrong check digit is only accepted if a book was
+    stored under it before ISBNs were checked (normalize_barcodes lists them)
+    """
+    try:
+        return canonical_barcode(barcode)
+    except InvalidISBN as e:
+        raw = clean(barcode)
+        stored = MetaBook.objects.filter(barcode__in=[barcode, raw])
+        for found in stored.values_list('barcode', flat=True)[:1]: return found
+        raise ValidationError(str(e))
+
 class NewBookForm(forms.Form):
     barcode = forms.CharField(max_length=50)
     seller = forms.IntegerField(label="Student ID", min_value=1)
@@ -29,7 +44,7 @@ class NewBookForm(forms.Form):
     book_id = forms.IntegerField(required=False, widget=forms.HiddenInput())
 
     def clean_barcode(self):
-        return self.cleaned_data['barcode'].replace('-', '')
+        return clean_barcode(self.cleaned_data['barcode'])
 
 class MetaBookForm(forms.ModelForm):
     class Meta:
@@ -46,6 +61,21 @@ class BookForm(forms.Form):
                                decimal_places=2)
     barcode = forms.CharField(max_length=50)
 
+    def __init__(self, *args, **kwargs):
+        """
+        Pass price_stats, the PriceStats of the book, to show a suggested price
+        """
+        price_stats = kwargs.pop('price_stats', None)
+        super(BookForm, self).__init__(*args, **kwargs)
+        if price_stats is not None:
+            self.fields['price'].help_text = price_help(price_stats)
+
+    def clean_barcode(self):
+        return clean_barcode(self.cleaned_data['barcode'])
+
+def price_help(stats):
+    return "Suggested $%s, %d sold between $%s and $%s" % (stats.suggested,
+        stats.sold, stats.lowest, stats.highest)
 
 class FilterForm(forms.Form):
     """
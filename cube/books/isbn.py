@@ -0,0 +1,58 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+ISBN checking and conversion. Books are stored under their ISBN-13 so that
+scanning either the ISBN-10 or the ISBN-13 of a book finds the same MetaBook
+"""
+
+import re
+
+ISBN10 = re.compile(r'^\d{9}[\dX]$')
+ISBN13 = re.compile(r'^97[89]\d{10}$')
+
+class InvalidISBN(ValueError):
+    pass
+
+def clean(code):
+    """
+    Strips the hyphens and spaces people and scanners put in barcodes
+    """
+    return code.replace('-', '').replace(' ', '').strip().upper()
+
+def isbn10_check_digit(digits):
+    """ Check digit for the first 9 digits of an ISBN-10 """
+    total = sum([(10 - i) * int(d) for i, d in enumerate(digits)])
+    check = (11 - total % 11) % 11
+    if check == 10: return 'X'
+    return str(check)
+
+def isbn13_check_digit(digits):
+    """ Check digit for the first 12 digits of an ISBN-13 """
+    total = sum([int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)])
+    return str((10 - total % 10) % 10)
+
+def to_isbn13(code):
+    """
+    Returns the ISBN-13 for code, converting from ISBN-10 if need be.
+    Returns None if code doesn't look like an ISBN at all and raises
+    InvalidISBN if it does but the check digit is wrong
+    """
+    code = clean(code)
+    if ISBN10.match(code):
+        if isbn10_check_digit(code[:9]) != code[9]:
+            raise InvalidISBN("%s is not a valid ISBN-10" % code)
+        body = '978' + code[:9]
+        return body + isbn13_check_digit(body)
+    if ISBN13.match(code):
+        if isbn13_check_digit(code[:12]) != code[12]:
+            raise InvalidISBN("%s is not a valid ISBN-13" % code)
+        return code
+    return None
+
+def canonical_barcode(code):
+    """
+    The form a barcode is stored in: the ISBN-13 if it is an ISBN,
+    otherwise the barcode without hyphens or spaces.
+    Raises InvalidISBN for ISBNs with a bad check digit
+    """
+    return to_isbn13(code) or clean(code)
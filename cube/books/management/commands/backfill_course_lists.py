@@ -0,0 +1,26 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import MetaBook, load_courses, fit_course_list
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+class Command(NoArgsCommand):
+    help = "Fills in the stored course list of every MetaBook. " \
+           "Databases created before the course_list column existed need " \
+           "it added first: ALTER TABLE books_metabook ADD COLUMN " \
+           "course_list varchar(250) NOT NULL DEFAULT ''; CREATE INDEX " \
+           "books_metabook_course_list ON books_metabook (course_list);"
+
+    def handle_noargs(self, **options):
+        count = 0
+        batch_size = 500
+        ids = list(MetaBook.objects.values_list('id', flat=True))
+        for start in range(0, len(ids), batch_size):
+            metabooks = list(MetaBook.objects.filter(id__in=ids[start:start + batch_size]))
+            load_courses(metabooks)
+            for metabook in metabooks:
+                codes = fit_course_list(metabook.course_codes())
+                MetaBook.objects.filter(pk=metabook.pk).update(course_list=codes)
+                count += 1
+            transaction.commit_unless_managed()
+        return "Updated the course list of %d metabooks\n" % count
@@ -0,0 +1,51 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import Log, replay_statuses
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+class Command(NoArgsCommand):
+    help = "Works out the from and to status of every Log entry by " \
+           "replaying the history of each book. Databases created before " \
+           "those columns existed need them added first: ALTER TABLE " \
+           "books_log ADD COLUMN from_status varchar(1) NOT NULL DEFAULT ''; " \
+           "ALTER TABLE books_log ADD COLUMN to_status varchar(1) NOT NULL " \
+           "DEFAULT ''; CREATE INDEX books_log_action_from_status ON " \
+           "books_log (action, from_status); Until this has been run the " \
+           "bad unholds report is empty, it only looks at logs with a " \
+           "from status."
+
+    def handle_noargs(self, **options):
+        self.count = 0
+        self.rows = []
+        qn = connection.ops.quote_name
+        self.sql = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+            qn(Log._meta.db_table), qn('from_status'), qn('to_status'),
+            qn('id'))
+        history = Log.objects.order_by('book', 'when', 'id')
+        book_id = None
+        logs = []
+        # Only one book's history is held in memory at a time
+        for id, book, action in history.values_list('id', 'book', 'action')\
+                                       .iterator():
+            if book != book_id:
+                self.replay(logs)
+                book_id = book
+                logs = []
+            logs.append((id, action))
+        self.replay(logs)
+        self.flush()
+        return "Filled in the statuses of %d log entries\n" % self.count
+
+    def replay(self, logs):
+        changes = replay_statuses([action for id, action in logs])
+        for (id, action), (from_status, to_status) in zip(logs, changes):
+            self.rows.append((from_status, to_status, id))
+        if len(self.rows) >= 1000: self.flush()
+
+    def flush(self):
+        if self.rows:
+            connection.cursor().executemany(self.sql, self.rows)
+            transaction.commit_unless_managed()
+        self.count += len(self.rows)
+        self.rows = []
@@ -0,0 +1,32 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.benchmarks import BENCHMARKS
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--size', dest='size', type='int', default=None,
+            help='Number of rows to build the dataset with'),
+    )
+    help = "Runs a benchmark against a throw-away test database. " \
+           "Available benchmarks: %s" % ', '.join(sorted(BENCHMARKS.keys()))
+    args = '<benchmark>'
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not BENCHMARKS.has_key(args[0]):
+            raise CommandError("Pick one of: %s" %
+                               ', '.join(sorted(BENCHMARKS.keys())))
+        func, size = BENCHMARKS[args[0]]
+        if options.get('size'): size = options['size']
+        old_name = connection.settings_dict['DATABASE_NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = func(size)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = ["%s with %d rows" % (args[0], size)]
+        for label, seconds in results:
+            output.append("%-40s %8.2f ms" % (label, seconds * 1000))
+        return '\n'.join(output) + '\n'
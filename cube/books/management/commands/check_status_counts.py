@@ -0,0 +1,41 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import Book, Counter, STATUS_COUNTER, count_statuses,\
+                              status_counters_on
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix',
+            default=False, help="Overwrite the counters with the real counts"),
+    )
+    help = "Counts the books with each status and compares the counts " \
+           "with the status counters kept when STATUS_COUNTERS is on. " \
+           "Use --fix to reset the counters, e.g. when turning them on"
+
+    def handle_noargs(self, **options):
+        actual = count_statuses()
+        kept = dict(Counter.objects.values_list('name', 'value'))
+        output = []
+        wrong = 0
+        for status, name in Book.STATUS_CHOICES:
+            counter = kept.get(STATUS_COUNTER % status, 0)
+            if counter != actual[status]:
+                wrong += 1
+                output.append("%s: counter says %d, there are %d\n" % (
+                    name, counter, actual[status]))
+            if options.get('fix'):
+                counter, created = Counter.objects.get_or_create(
+                    name=STATUS_COUNTER % status)
+                counter.value = actual[status]
+                counter.save()
+        transaction.commit_unless_managed()
+        if not status_counters_on():
+            output.append("STATUS_COUNTERS is off, the counters aren't used\n")
+        if wrong and options.get('fix'):
+            output.append("Fixed %d counters\n" % wrong)
+        elif not wrong:
+            output.append("All counters are right\n")
+        return ''.join(output)
@@ -0,0 +1,44 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import acquire_lease, release_lease
+from cube.books.views.tools import house_cleaning
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, reset_queries
+from optparse import make_option
+from socket import gethostname
+from time import sleep
+import os
+
+LEASE_NAME = 'house_cleaning'
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help="Keep running, cleaning every interval"),
+        make_option('--interval', dest='interval', type='int', default=None,
+            help="Seconds between runs. Defaults to HOUSE_CLEANING_INTERVAL"),
+    )
+    help = "Expires old holds, marks year old books as To Be Deleted " \
+           "and refreshes price stats that are a day old. " \
+           "Run it from cron, or once with --loop. Only one worker " \
+           "cleans at a time, however many are running"
+
+    def handle_noargs(self, **options):
+        interval = options.get('interval') or \
+                   getattr(settings, 'HOUSE_CLEANING_INTERVAL', 300)
+        holder = "%s:%d" % (gethostname(), os.getpid())
+        try:
+            while True:
+                # DEBUG keeps every query, which adds up in a long run
+                reset_queries()
+                # Hold the lease for two intervals so it doesn't run out
+                # while we sleep, but a dead worker is replaced quickly
+                if acquire_lease(LEASE_NAME, holder, interval * 2):
+                    house_cleaning()
+                if not options.get('loop'): break
+                # don't hold a connection open while there's nothing to do
+                connection.close()
+                sleep(interval)
+        finally:
+            release_lease(LEASE_NAME, holder)
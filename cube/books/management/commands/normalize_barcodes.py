@@ -0,0 +1,65 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.isbn import canonical_barcode, InvalidISBN
+from cube.books.models import Book, MetaBook, bump_version_once,\
+                              BOOKS_VERSION
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from optparse import make_option
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help="Only say what would be changed"),
+    )
+    help = "Stores every ISBN barcode as an ISBN-13 and merges MetaBooks " \
+           "which turn out to be the same book. Barcodes with a wrong " \
+           "check digit are listed so they can be fixed by hand; until " \
+           "then they can still be scanned exactly as stored"
+
+    def handle_noargs(self, **options):
+        dry_run = options.get('dry_run', False)
+        by_barcode = {}
+        invalid = []
+        for metabook in MetaBook.objects.order_by('id'):
+            try:
+                barcode = canonical_barcode(metabook.barcode)
+            except InvalidISBN:
+                invalid.append(metabook.barcode)
+                continue
+            by_barcode.setdefault(barcode, []).append(metabook)
+
+        output = []
+        for barcode, metabooks in by_barcode.items():
+            # keep the one already stored under the right barcode if there
+            # is one, otherwise the oldest
+            keeper = metabooks[0]
+            for metabook in metabooks:
+                if metabook.barcode == barcode:
+                    keeper = metabook
+                    break
+            duplicates = [m for m in metabooks if m.id != keeper.id]
+            if keeper.barcode == barcode and not duplicates: continue
+            for duplicate in duplicates:
+                output.append("Merging %s (%s) into %s (%s)" % (
+                    duplicate.id, duplicate.barcode, keeper.id, keeper.barcode))
+            if keeper.barcode != barcode:
+                output.append("Renaming %s to %s" % (keeper.barcode, barcode))
+            if not dry_run:
+                self.merge(keeper, duplicates, barcode)
+        for barcode in invalid:
+            output.append("Left %s alone, its check digit is wrong" % barcode)
+        output.append("")
+        return '\n'.join(output)
+
+    def merge(self, keeper, duplicates, barcode):
+        for duplicate in duplicates:
+            Book.objects.filter(metabook=duplicate).update(metabook=keeper)
+            for course in duplicate.courses.all():
+                keeper.courses.add(course)
+            duplicate.delete()
+        keeper.barcode = barcode
+        keeper.save()
+        keeper.update_course_list()
+    merge = bump_version_once(BOOKS_VERSION)(merge)
+    merge = transaction.commit_on_success(merge)
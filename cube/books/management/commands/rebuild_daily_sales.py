@@ -0,0 +1,13 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import rebuild_daily_sales
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the daily sales rollup used by the sales reports " \
+           "from the sell date of every book. Run it after changing " \
+           "the courses of books that have sold, since sales count " \
+           "towards the department of their first course"
+
+    def handle_noargs(self, **options):
+        return "Rolled up sales for %d days\n" % rebuild_daily_sales()
@@ -0,0 +1,11 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.search import rebuild_index
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the search index used by the book list search box"
+
+    def handle_noargs(self, **options):
+        count = rebuild_index()
+        return "Indexed %d metabooks\n" % count
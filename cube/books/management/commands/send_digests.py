@@ -0,0 +1,14 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.email import send_digests, digest_savings
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = "Queues one email per seller with everything that happened to " \
+           "their books since the last digest. Only needed with " \
+           "EMAIL_DIGEST on, run it from cron once per digest window"
+
+    def handle_noargs(self, **options):
+        queued = send_digests()
+        return "Queued %d digests, %d emails saved so far\n" % (
+            queued, digest_savings())
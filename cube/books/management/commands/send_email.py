@@ -0,0 +1,36 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.outbox import drain
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection, reset_queries
+from optparse import make_option
+from time import sleep
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help="Keep running, sending every interval"),
+        make_option('--interval', dest='interval', type='int', default=10,
+            help="Seconds between looking for new emails"),
+        make_option('--threads', dest='threads', type='int', default=None,
+            help="Number of sending threads. Defaults to EMAIL_WORKER_THREADS"),
+    )
+    help = "Sends the emails waiting in the outbox. Run it from cron, " \
+           "or once with --loop. Any number of these can run at once"
+
+    def handle_noargs(self, **options):
+        threads = options.get('threads') or \
+                  getattr(settings, 'EMAIL_WORKER_THREADS', 4)
+        total_sent = total_failed = 0
+        while True:
+            # DEBUG keeps every query, which adds up in a long run
+            reset_queries()
+            sent, failed = drain(threads)
+            total_sent += sent
+            total_failed += failed
+            if not options.get('loop'): break
+            # don't hold a connection open while there's nothing to do
+            connection.close()
+            sleep(options.get('interval'))
+        return "Sent %d emails, %d failed\n" % (total_sent, total_failed)
@@ -1,8 +1,16 @@
 # Copyright (C) 2010  Trinity Western University
 
-from datetime import datetime
-from django.db import models
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import wraps
+from django.db import connection, models, transaction, IntegrityError
+from django.conf import settings
+from django.db.models import Count, F
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_init, post_save, pre_delete,\
+                                      post_delete
 from django.contrib.auth.models import User
+from threading import local
 
 DEPARTMENT_CHOICES = (
     ('ALDR', 'ALDR - MA Leadership'),
@@ -122,6 +130,20 @@ class Course(models.Model):
     def __unicode__(self):
         return self.code()
 
+class VersionedQuerySet(QuerySet):
+    """
+    Bumps the books data version whenever rows are changed in bulk
+    with update()
+    """
+    def update(self, **kwargs):
+        rows = super(VersionedQuerySet, self).update(**kwargs)
+        if rows: bump_version(BOOKS_VERSION)
+        return rows
+
+class VersionedManager(models.Manager):
+    def get_query_set(self):
+        return VersionedQuerySet(self.model)
+
 class MetaBook(models.Model):
     """
     Information on a book (as opposed to a particular copy of it)
@@ -132,23 +154,91 @@ class MetaBook(models.Model):
     barcode = models.CharField(max_length=50, unique=True)
     edition = models.PositiveSmallIntegerField()
     courses = models.ManyToManyField(Course)
+    # course_codes() stored so lists can show and sort by it without
+    # going through the courses table. Kept up to date by update_course_list
+    course_list = models.CharField(max_length=250, blank=True, default='',
+                                   db_index=True, editable=False)
+
+    objects = VersionedManager()
 
     def __unicode__(self):
         return self.title
 
+    def update_course_list(self):
+        """
+        Stores the current course codes on the metabook.
+        Call this whenever the courses of a metabook change
+        """
+        self._course_cache = list(self.courses.all())
+        self.course_list = fit_course_list(self.course_codes())
+        # update() rather than save() so the search index isn't rebuilt
+        MetaBook.objects.filter(pk=self.pk).update(course_list=self.course_list)
+
     def course_codes(self):
         """
         returns a list of courses in the form
         course1, course2, course3
         """
-        course_list = ""
-        for course in self.courses.all():
-            course_list += "%s, " % course.code()
-        # [:-2] takes off the trailing comma and space
-        return course_list[:-2]
+        # load_courses() may have fetched these already
+        courses = getattr(self, '_course_cache', None)
+        if courses is None:
+            if self.course_list:
+                return self.course_list
+            courses = self.courses.all()
+        return ', '.join([course.code() for course in courses])
     def title_list(self):
         return self.author
 
+def fit_course_list(codes):
+    """
+    Cuts course codes down to fit in MetaBook.course_list, dropping whole
+    codes off the end for books on a lot of courses
+    """
+    length = MetaBook._meta.get_field('course_list').max_length
+    if len(codes) <= length: return codes
+    return codes[:length + 2].rsplit(', ', 1)[0]
+
+def course_changed(sender, instance, **kwargs):
+    """
+    The code of a course is part of the stored course list of its metabooks
+    """
+    # connected before update_search_index, so _indexed is still the code
+    # the course was loaded with
+    if getattr(instance, '_indexed', None) == instance.code(): return
+    for metabook in instance.metabook_set.all():
+        metabook.update_course_list()
+post_save.connect(course_changed, sender=Course)
+
+def course_deleting(sender, instance, **kwargs):
+    # the metabooks can't be found any more once the course is gone
+    instance._metabook_ids = list(instance.metabook_set.values_list('id', flat=True))
+pre_delete.connect(course_deleting, sender=Course)
+
+def course_deleted(sender, instance, **kwargs):
+    for metabook in MetaBook.objects.filter(id__in=instance._metabook_ids):
+        metabook.update_course_list()
+post_delete.connect(course_deleted, sender=Course)
+
+def load_courses(metabooks):
+    """
+    Fetches the courses of all the given metabooks in one query and hands
+    them to each metabook, so that course_codes() doesn't run a query
+    for every row of a list
+    """
+    metabooks = list(metabooks)
+    if not metabooks: return
+    m2m = MetaBook._meta.get_field('courses')
+    qn = connection.ops.quote_name
+    column = "%s.%s" % (qn(m2m.m2m_db_table()), qn(m2m.m2m_column_name()))
+    ids = set([metabook.id for metabook in metabooks])
+    courses = Course.objects.filter(metabook__in=ids)\
+                            .extra(select={'metabook_id' : column})
+    by_metabook = {}
+    for course in courses:
+        by_metabook.setdefault(course.metabook_id, []).append(course)
+    for metabook in metabooks:
+        metabook._course_cache = by_metabook.get(metabook.id, [])
+
 class Book(models.Model):
     """
     For when a student lists a particular copy of a book.
@@ -172,39 +262,33 @@ class Book(models.Model):
     metabook = models.ForeignKey(MetaBook)
     list_date = models.DateTimeField('Date Listed', default=datetime.now)
     seller = models.ForeignKey(User, related_name="selling")
-    sell_date = models.DateTimeField('Date Sold', blank=True, null=True)
+    sell_date = models.DateTimeField('Date Sold', blank=True, null=True,
+                                     db_index=True)
     holder = models.ForeignKey(User, related_name="holding", blank=True, null=True)
     hold_date = models.DateTimeField('Date Held', blank=True, null=True)
     price = models.DecimalField(max_digits=7, decimal_places=2)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='F')
     is_legacy = models.BooleanField(default=False)
 
+    objects = VersionedManager()
+
     def __unicode__(self):
         return "%s listed by %s on %s" % (self.metabook, self.seller, self.list_date.date())
 
     def previous_status(self):
-        # Map the various log actions to their equivalent book status
-        action_to_choice = {
-            'A' : 'F', # -> For Sale
-            'M' : 'M', # -> Missing
-            'O' : 'O', # -> On Hold
-            'X' : 'O', # -> On Hold
-            'R' : 'F', # -> For Sale
-            'P' : 'P', # -> Seller Paid
-            'S' : 'S', # -> Sold
-            'T' : 'T', # -> To Be Deleted
-            'D' : 'D', # -> Deleted
-        }
-
-        # There are some log actions that don't correspond to a book status, if the previous
-        # action is one of these, discard it and go to the action before that, etc...
-        # For example, we don't want to revert to a deleted or undeleted status
-        history = Log.objects.filter(book=self.id).exclude(action='D').exclude(action='E').exclude(action='U').order_by('when').reverse()
-
-        # Loop through previous logs and return it if it is in our action_to_choice mapping 
-        for log_point in history:
-            if log_point.action in action_to_choice.keys():
-                return action_to_choice[log_point.action]
+        """
+        The status this book had before it was deleted, see previous_statuses
+        """
+        return previous_statuses([self.id]).get(self.id, '')
+
+    def status_at(self, when):
+        """
+        The status this book had at the time when, or '' if it wasn't
+        listed yet
+        """
+        logs = Log.objects.filter(book=self, when__lte=when)
+        logs = logs.order_by('-when', '-id').values_list('to_status', flat=True)
+        for status in logs[:1]: return status
         return ''
 
 class Log(models.Model):
@@ -228,6 +312,659 @@ class Log(models.Model):
     when = models.DateTimeField(default=datetime.now)
     book = models.ForeignKey(Book, related_name="logs")
     who = models.ForeignKey(User, related_name="actions")
+    # The status of the book just before and just after the action
+    from_status = models.CharField(max_length=1, choices=Book.STATUS_CHOICES,
+                                   blank=True, default='')
+    to_status = models.CharField(max_length=1, choices=Book.STATUS_CHOICES,
+                                 blank=True, default='')
 
     def __unicode__(self):
         return "%s %s" % (self.who.get_full_name(), self.when)
+
+def insert_logs(rows, when=None):
+    """
+    Writes many Log entries with one statement.
+    rows is a list of (action, book id, who id, from status, to status)
+    """
+    if not rows: return
+    if when is None: when = datetime.now()
+    qn = connection.ops.quote_name
+    columns = ('action', 'when', 'book_id', 'who_id', 'from_status',
+               'to_status')
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(Log._meta.db_table),
+        ', '.join([qn(c) for c in columns]), ', '.join(['%s'] * len(columns)))
+    connection.cursor().executemany(sql,
+        [(row[0], when) + tuple(row[1:]) for row in rows])
+
+def lock_books(ids):
+    """
+    Stops anybody else changing the books in ids until the transaction
+    ends, so what is read of them afterwards stays true until then
+    """
+    ids = [int(id) for id in ids]
+    if not ids: return
+    qn = connection.ops.quote_name
+    table = qn(Book._meta.db_table)
+    cursor = connection.cursor()
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        # sqlite locks the whole database, starting a write takes the lock
+        cursor.execute("UPDATE %s SET %s = %s WHERE 1 = 0" % (
+            table, qn('id'), qn('id')))
+    else:
+        cursor.execute("SELECT %s FROM %s WHERE %s IN (%s) FOR UPDATE" % (
+            qn('id'), table, qn('id'), ', '.join(['%s'] * len(ids))), ids)
+
+# Map the various log actions to their equivalent book status
+# There are some log actions that don't correspond to a book status, like
+# Edited and Undeleted, and we never want to revert to a deleted status
+ACTION_STATUS = {
+    'A' : 'F', # -> For Sale
+    'M' : 'M', # -> Missing
+    'O' : 'O', # -> On Hold
+    'X' : 'O', # -> On Hold
+    'R' : 'F', # -> For Sale
+    'P' : 'P', # -> Seller Paid
+    'S' : 'S', # -> Sold
+    'T' : 'T', # -> To Be Deleted
+}
+
+def previous_statuses(book_ids):
+    """
+    Returns a dict of book id -> the status the book had just before it was
+    last deleted. Deletes logged before log entries recorded their statuses
+    are worked out by replaying the book's history. Books that were never
+    deleted, or whose status can't be worked out, are left out. Done in two
+    queries however many books there are
+    """
+    deletes = Log.objects.filter(book__in=book_ids, action='D')
+    deletes = deletes.order_by('book', 'when', 'id')
+    last = {}
+    # later deletes overwrite earlier ones
+    for book_id, status in deletes.values_list('book', 'from_status').iterator():
+        last[book_id] = status
+    found = dict([(id, status) for id, status in last.items() if status])
+    unknown = [id for id, status in last.items() if not status]
+    if not unknown: return found
+    history = Log.objects.filter(book__in=unknown).order_by('book', 'when', 'id')
+    actions = {}
+    for book_id, action in history.values_list('book', 'action').iterator():
+        actions.setdefault(book_id, []).append(action)
+    for book_id, book_actions in actions.items():
+        changes = replay_statuses(book_actions)
+        status = ''
+        for action, (from_status, to_status) in zip(book_actions, changes):
+            if action == 'D': status = from_status
+        if status: found[book_id] = status
+    return found
+
+def replay_statuses(actions, status=''):
+    """
+    Works out the (from status, to status) of each of a book's log actions,
+    oldest first, starting from status
+    """
+    changes = []
+    # what an undelete goes back to
+    restore = status
+    for action in actions:
+        if action == 'U': to_status = restore
+        elif action == 'E': to_status = status
+        elif action == 'D': to_status = 'D'
+        else: to_status = ACTION_STATUS.get(action, status)
+        if action in ACTION_STATUS: restore = to_status
+        changes.append((status, to_status))
+        status = to_status
+    return changes
+
+class SearchGram(models.Model):
+    """
+    One three letter chunk of a MetaBook's title, author or barcode.
+    book_filter looks these up instead of scanning with LIKE '%...%'
+    """
+    gram = models.CharField(max_length=3, db_index=True)
+    metabook = models.ForeignKey(MetaBook, related_name="grams")
+
+    class Meta:
+        unique_together = ("gram", "metabook")
+
+    def __unicode__(self):
+        return "%s in %s" % (self.gram, self.metabook)
+
+class PrefixChange(models.Model):
+    """
+    One change to the metabooks or courses, stored under the metabooks
+    version it made so that other processes can apply it to their
+    suggestion index instead of rebuilding it. Only the latest few are kept
+    """
+    version = models.PositiveIntegerField(unique=True)
+    # not a ForeignKey, the metabook may have been deleted
+    metabook_id = models.IntegerField(null=True, blank=True)
+    old_code = models.CharField(max_length=8, null=True, blank=True)
+    code = models.CharField(max_length=8, null=True, blank=True)
+
+    def __unicode__(self):
+        return "v%d" % self.version
+
+def indexed_values(instance):
+    """
+    What the search index and suggestions know a MetaBook or Course by
+    """
+    if isinstance(instance, Course): return instance.code()
+    return (instance.title, instance.author, instance.barcode)
+
+def remember_indexed(sender, instance, **kwargs):
+    instance._indexed = indexed_values(instance)
+post_init.connect(remember_indexed, sender=MetaBook)
+post_init.connect(remember_indexed, sender=Course)
+
+def update_search_index(sender, instance, created=False, **kwargs):
+    """
+    Keeps the search index and the search box suggestions up to date
+    whenever a MetaBook or Course is saved. Saves which don't change what
+    it is found by leave them alone
+    """
+    # imported here because cube.books.search imports this module
+    from cube.books.search import index_metabook, metabooks_changed
+    before = getattr(instance, '_indexed', None)
+    instance._indexed = indexed_values(instance)
+    if not created and before == instance._indexed: return
+    if sender is Course:
+        if created: before = None
+        metabooks_changed(course=instance, old_code=before)
+    else:
+        index_metabook(instance)
+        metabooks_changed(metabook=instance)
+post_save.connect(update_search_index, sender=MetaBook)
+post_save.connect(update_search_index, sender=Course)
+
+def remove_from_search(sender, instance, **kwargs):
+    from cube.books.search import metabooks_changed
+    if sender is Course:
+        metabooks_changed(course=instance, deleted=True,
+                          old_code=getattr(instance, '_indexed', None))
+    else:
+        metabooks_changed(metabook=instance, deleted=True)
+post_delete.connect(remove_from_search, sender=MetaBook)
+post_delete.connect(remove_from_search, sender=Course)
+
+# Name of the DataVersion bumped whenever a Book or MetaBook changes
+BOOKS_VERSION = 'books'
+
+class DataVersion(models.Model):
+    """
+    A counter which goes up every time the data it is named after changes.
+    Lets each process know when what it has cached is out of date
+    """
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s v%d" % (self.name, self.version)
+
+def get_version(name):
+    """
+    Returns the current version of the data called name
+    """
+    try:
+        return DataVersion.objects.get(name=name).version
+    except DataVersion.DoesNotExist:
+        return 0
+
+# Names of the data whose bumps are being put off, per thread
+_deferred = local()
+
+def bump_version(name):
+    """
+    Marks the data called name as changed
+    """
+    pending = getattr(_deferred, 'names', {})
+    if name in pending:
+        pending[name] = True
+        return
+    bumped = DataVersion.objects.filter(name=name)\
+                                .update(version=F('version') + 1)
+    if not bumped:
+        defaults = {'version' : 1}
+        version, created = DataVersion.objects.get_or_create(name=name,
+                                                             defaults=defaults)
+        if not created:
+            DataVersion.objects.filter(name=name)\
+                               .update(version=F('version') + 1)
+
+def bump_version_once(name):
+    """
+    Decorator which turns all the bumps of the data called name made by
+    the function into one, made as it returns. Put it inside
+    commit_on_success so a transaction that changes many books takes the
+    version row's lock once, at the end
+    """
+    def decorator(func):
+        def bump_once(*args, **kwargs):
+            if not hasattr(_deferred, 'names'): _deferred.names = {}
+            pending = _deferred.names
+            # the outermost call does the bump
+            if name in pending: return func(*args, **kwargs)
+            pending[name] = False
+            try:
+                result = func(*args, **kwargs)
+                bumped = pending[name]
+            finally:
+                del pending[name]
+            if bumped: bump_version(name)
+            return result
+        return wraps(func)(bump_once)
+    return decorator
+
+def books_changed(sender, **kwargs):
+    bump_version(BOOKS_VERSION)
+# Logs are always written along with the books they are about, which
+# bump the version themselves
+post_save.connect(books_changed, sender=Book)
+post_save.connect(books_changed, sender=MetaBook)
+post_delete.connect(books_changed, sender=Book)
+post_delete.connect(books_changed, sender=MetaBook)
+
+class Lease(models.Model):
+    """
+    Lets one worker at a time claim a job, e.g. house cleaning.
+    A lease that isn't renewed before it expires can be taken over
+    """
+    name = models.CharField(max_length=50, unique=True)
+    holder = models.CharField(max_length=100)
+    expires = models.DateTimeField()
+
+    def __unicode__(self):
+        return "%s held by %s until %s" % (self.name, self.holder, self.expires)
+
+def acquire_lease(name, holder, seconds):
+    """
+    Claims (or renews) the lease called name for seconds.
+    Returns True if holder now has the lease
+    """
+    now = datetime.now()
+    expires = now + timedelta(seconds=seconds)
+    # A single UPDATE so two workers can't both think they got it
+    free = models.Q(expires__lt=now) | models.Q(holder=holder)
+    if Lease.objects.filter(free, name=name).update(holder=holder, expires=expires):
+        return True
+    try:
+        Lease(name=name, holder=holder, expires=expires).save()
+        return True
+    except IntegrityError:
+        # somebody else holds it
+        transaction.rollback_unless_managed()
+        return False
+
+def release_lease(name, holder):
+    """
+    Gives up a lease early so another worker can take it straight away
+    """
+    Lease.objects.filter(name=name, holder=holder).delete()
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting to be sent by the send_email command. Emails are
+    queued in the same transaction as the change they're about, so a
+    rolled back change never sends anything
+    """
+    STATUS_CHOICES = (
+        (u'Q', u'Queued'),
+        (u'S', u'Sent'),
+        (u'F', u'Failed'),
+    )
+    subject = models.CharField(max_length=255)
+    from_email = models.CharField(max_length=255)
+    # comma separated addresses
+    to = models.TextField()
+    text_content = models.TextField()
+    html_content = models.TextField(blank=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES,
+                              default='Q', db_index=True)
+    created = models.DateTimeField(default=datetime.now)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    claimed_by = models.CharField(max_length=100, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    sent = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s to %s" % (self.subject, self.to)
+
+class Counter(models.Model):
+    """
+    A named running total, e.g. how many emails the digest saved
+    """
+    name = models.CharField(max_length=50, unique=True)
+    value = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s: %d" % (self.name, self.value)
+
+def get_counter(name):
+    try:
+        return Counter.objects.get(name=name).value
+    except Counter.DoesNotExist:
+        return 0
+
+def increment_counter(name, amount=1):
+    """
+    Adds amount to the counter called name, creating it if need be
+    """
+    added = Counter.objects.filter(name=name)\
+                           .update(value=F('value') + amount)
+    if not added:
+        defaults = {'value' : amount}
+        counter, created = Counter.objects.get_or_create(name=name,
+                                                         defaults=defaults)
+        if not created:
+            Counter.objects.filter(name=name)\
+                           .update(value=F('value') + amount)
+
+# Name of the Counter of books with each status
+STATUS_COUNTER = 'status_%s'
+
+def status_counters_on():
+    """
+    The status counters are only kept up to date with STATUS_COUNTERS on
+    """
+    return getattr(settings, 'STATUS_COUNTERS', False)
+
+def count_status_changes(changes):
+    """
+    changes is a list of (from status, to status) of books that moved, with
+    '' for books that were just added or removed. Call it in the same
+    transaction as the change so the counters never drift
+    """
+    if not status_counters_on(): return
+    totals = {}
+    for from_status, to_status in changes:
+        if from_status == to_status: continue
+        if from_status: totals[from_status] = totals.get(from_status, 0) - 1
+        if to_status: totals[to_status] = totals.get(to_status, 0) + 1
+    for status, amount in totals.items():
+        if amount: increment_counter(STATUS_COUNTER % status, amount)
+
+def count_statuses():
+    """
+    Counts the books with each status with a single grouped query.
+    Returns a dict of status -> number of books
+    """
+    counts = dict([(status, 0) for status, name in Book.STATUS_CHOICES])
+    grouped = Book.objects.values('status').annotate(count=Count('id'))
+    for row in grouped.order_by():
+        counts[row['status']] = row['count']
+    return counts
+
+def status_counts():
+    """
+    Number of books with each status, read from the counters if they are
+    being kept and counted otherwise
+    """
+    if not status_counters_on(): return count_statuses()
+    counts = dict([(status, 0) for status, name in Book.STATUS_CHOICES])
+    names = [STATUS_COUNTER % status for status in counts]
+    for name, value in Counter.objects.filter(name__in=names)\
+                                      .values_list('name', 'value'):
+        counts[name[-1]] = value
+    return counts
+
+def remember_status(sender, instance, **kwargs):
+    instance._saved_status = instance.status
+post_init.connect(remember_status, sender=Book)
+
+def book_saved(sender, instance, created, **kwargs):
+    """
+    Counts a status change made by saving a book, e.g. from the admin.
+    Changes made with QuerySet.update are counted by whoever made them
+    """
+    if created: count_status_changes([('', instance.status)])
+    else: count_status_changes([(instance._saved_status, instance.status)])
+    instance._saved_status = instance.status
+post_save.connect(book_saved, sender=Book)
+
+def book_removed(sender, instance, **kwargs):
+    count_status_changes([(instance.status, '')])
+post_delete.connect(book_removed, sender=Book)
+
+class SellerNotice(models.Model):
+    """
+    Something a seller will be told about in their next digest email,
+    used instead of an email per change when EMAIL_DIGEST is on
+    """
+    KIND_CHOICES = (
+        (u'S', u'Sold'),
+        (u'M', u'Missing'),
+        (u'T', u'To Be Deleted'),
+    )
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    book = models.ForeignKey(Book)
+    seller = models.ForeignKey(User, related_name="notices")
+    created = models.DateTimeField(default=datetime.now)
+
+    def __unicode__(self):
+        return "%s %s" % (self.get_kind_display(), self.book)
+
+class DailySales(models.Model):
+    """
+    The books sold on one day for one department, kept up to date by
+    add_daily_sales so date range reports don't scan every sale.
+    A book counts towards the first department of its courses
+    """
+    day = models.DateField(db_index=True)
+    department = models.CharField(max_length=4, blank=True)
+    books = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    sellers = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("day", "department")
+
+    def __unicode__(self):
+        return "%s %s: %d books" % (self.day, self.department, self.books)
+
+def _insert_daily_sales(day, totals):
+    """
+    totals is a dict of department -> [books, revenue, set of seller ids]
+    """
+    for department, (books, revenue, sellers) in totals.items():
+        DailySales(day=day, department=department, books=books,
+                   revenue=revenue, sellers=len(sellers)).save()
+
+def _add_sale(totals, seller_id, price, course_list):
+    # course_list starts with the (padded) department of the first course
+    department = course_list[:4]
+    if not totals.has_key(department):
+        totals[department] = [0, 0, set()]
+    total = totals[department]
+    total[0] += 1
+    total[1] += price
+    total[2].add(seller_id)
+
+SALE_FIELDS = ('seller', 'price', 'metabook__course_list')
+
+def _change_daily_sales(day, department, **amounts):
+    """
+    Adds amounts to the fields of the rollup row for day and department,
+    creating it if need be
+    """
+    rows = DailySales.objects.filter(day=day, department=department)
+    changes = dict([(field, F(field) + amount)
+                    for field, amount in amounts.items()])
+    if rows.update(**changes): return
+    row, created = DailySales.objects.get_or_create(day=day,
+        department=department, defaults=amounts)
+    if not created: rows.update(**changes)
+
+def _roll_sales(ids, sign):
+    sold = Book.objects.filter(id__in=ids, sell_date__isnull=False)
+    by_day = {}
+    for sell_date, seller_id, price, course_list in \
+            sold.values_list('sell_date', *SALE_FIELDS):
+        _add_sale(by_day.setdefault(sell_date.date(), {}),
+                  seller_id, price, course_list)
+    for day, totals in by_day.items():
+        start = datetime(day.year, day.month, day.day)
+        for department, (books, revenue, sellers) in totals.items():
+            # this locks the row until commit, so the other sales read
+            # below include any made at the same time
+            _change_daily_sales(day, department, books=sign * books,
+                                revenue=sign * revenue)
+            others = Book.objects.filter(sell_date__gte=start,
+                sell_date__lt=start + timedelta(1), seller__in=sellers)
+            others = others.exclude(id__in=ids)
+            for seller_id, course_list in \
+                    others.values_list('seller', 'metabook__course_list'):
+                if course_list[:4] == department: sellers.discard(seller_id)
+            if sellers:
+                _change_daily_sales(day, department,
+                                    sellers=sign * len(sellers))
+
+def add_daily_sales(ids):
+    """
+    Adds the sold books in ids to the rollup. Call it in the same
+    transaction as anything that sells a book
+    """
+    _roll_sales(ids, 1)
+
+def remove_daily_sales(ids):
+    """
+    Takes the sold books in ids out of the rollup, e.g. before their
+    price or seller is changed. A sale is taken out of the department of
+    its book's courses now, so after courses are changed run
+    rebuild_daily_sales to move old sales to their new department
+    """
+    _roll_sales(ids, -1)
+
+def rebuild_daily_sales():
+    """
+    Throws away the whole rollup and builds it again from every sale.
+    Returns the number of days with sales
+    """
+    DailySales.objects.all().delete()
+    sold = Book.objects.filter(sell_date__isnull=False).order_by('sell_date')
+    day = None
+    totals = {}
+    count = 0
+    for sell_date, seller_id, price, course_list in \
+            sold.values_list('sell_date', *SALE_FIELDS).iterator():
+        if sell_date.date() != day:
+            if day is not None: _insert_daily_sales(day, totals)
+            day = sell_date.date()
+            totals = {}
+            count += 1
+        _add_sale(totals, seller_id, price, course_list)
+    if day is not None: _insert_daily_sales(day, totals)
+    transaction.commit_unless_managed()
+    return count
+
+class PriceStats(models.Model):
+    """
+    What copies of a MetaBook have sold for, kept up to date by
+    update_price_stats whenever one sells so intake can suggest a price
+    with a single lookup
+    """
+    metabook = models.OneToOneField(MetaBook, related_name="price_stats")
+    sold = models.IntegerField(default=0)
+    lowest = models.DecimalField(max_digits=7, decimal_places=2)
+    lower_quartile = models.DecimalField(max_digits=7, decimal_places=2)
+    median = models.DecimalField(max_digits=7, decimal_places=2)
+    upper_quartile = models.DecimalField(max_digits=7, decimal_places=2)
+    highest = models.DecimalField(max_digits=7, decimal_places=2)
+    # copies sold in the RECENT_DAYS before the stats were updated
+    recent_sales = models.IntegerField(default=0)
+    last_sale = models.DateTimeField(null=True, blank=True)
+    suggested = models.DecimalField(max_digits=7, decimal_places=2)
+    updated = models.DateTimeField(default=datetime.now, db_index=True)
+
+    def __unicode__(self):
+        return "%s: $%s" % (self.metabook, self.suggested)
+
+    def sales_per_week(self):
+        return self.recent_sales * 7.0 / RECENT_DAYS
+
+# How far back sales count towards how quickly a book is selling
+RECENT_DAYS = 56
+# Books selling at least this many copies a week are priced higher
+FAST_SALES_PER_WEEK = 2
+
+def percentile(prices, fraction):
+    """
+    The value fraction of the way through the sorted list prices,
+    interpolating between the two nearest prices
+    """
+    position = (len(prices) - 1) * fraction
+    below = int(position)
+    above = min(below + 1, len(prices) - 1)
+    step = Decimal(str(position - below))
+    value = prices[below] + (prices[above] - prices[below]) * step
+    return value.quantize(Decimal('0.01'))
+
+def suggest_price(stats):
+    """
+    The median sale price, nudged up for books that sell quickly and down
+    for ones that haven't sold lately, rounded to the nearest 50 cents
+    """
+    price = stats.median
+    if stats.sales_per_week() >= FAST_SALES_PER_WEEK:
+        price = stats.upper_quartile
+    elif not stats.recent_sales:
+        price = stats.lower_quartile
+    return ((price * 2).quantize(Decimal('1')) / 2).quantize(Decimal('0.01'))
+
+PRICE_FIELDS = ('sold', 'lowest', 'lower_quartile', 'median',
+                'upper_quartile', 'highest', 'recent_sales', 'last_sale',
+                'suggested', 'updated')
+
+def update_price_stats(metabook_ids, now=None):
+    """
+    Works out the price stats of each of metabook_ids again from its
+    sold copies, updating the row in place or creating it if need be.
+    Call it in the same transaction as anything that sells a book
+    """
+    if now is None: now = datetime.now()
+    recent = now - timedelta(RECENT_DAYS)
+    for metabook_id in set(metabook_ids):
+        rows = PriceStats.objects.filter(metabook=metabook_id)
+        # this locks the row until commit, so the sales read below
+        # include any made at the same time
+        found = rows.update(updated=now)
+        sold = Book.objects.filter(metabook=metabook_id, sell_date__isnull=False)
+        sales = list(sold.values_list('price', 'sell_date'))
+        if not sales:
+            if found: rows.delete()
+            continue
+        prices = sorted([price for price, sell_date in sales])
+        stats = PriceStats(metabook_id=metabook_id, sold=len(prices),
+            lowest=prices[0], lower_quartile=percentile(prices, 0.25),
+            median=percentile(prices, 0.5),
+            upper_quartile=percentile(prices, 0.75), highest=prices[-1],
+            recent_sales=len([d for p, d in sales if d >= recent]),
+            last_sale=max([d for p, d in sales]), updated=now)
+        stats.suggested = suggest_price(stats)
+        fields = dict([(name, getattr(stats, name)) for name in PRICE_FIELDS])
+        if found:
+            rows.update(**fields)
+            continue
+        sid = transaction.savepoint()
+        try:
+            stats.save(force_insert=True)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # somebody else sold the first copy at the same time
+            transaction.savepoint_rollback(sid)
+            rows.update(**fields)
+
+def refresh_price_stats(days=1):
+    """
+    Updates the stats that haven't been touched in days and were selling
+    lately, so that books which stopped selling stop looking like they
+    sell quickly. Stats with no recent sales have nothing left to change.
+    Returns the number refreshed
+    """
+    now = datetime.now()
+    stale = PriceStats.objects.filter(updated__lt=now - timedelta(days))
+    stale = stale.filter(models.Q(recent_sales__gt=0) |
+                         models.Q(last_sale__gte=now - timedelta(RECENT_DAYS)))
+    ids = list(stale.values_list('metabook', flat=True))
+    update_price_stats(ids, now)
+    transaction.commit_unless_managed()
+    return len(ids)
@@ -0,0 +1,154 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+Outgoing email queue. Views queue their emails with queue_email inside the
+same transaction as the change they're about, and the send_email command
+drains the queue in the background over reused SMTP connections
+"""
+
+from cube.books.models import OutgoingEmail
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
+from datetime import datetime, timedelta
+from socket import gethostname
+from threading import Thread, Lock
+from uuid import uuid4
+import os
+
+# How long a worker has to send a batch before somebody else may take it
+CLAIM_SECONDS = 600
+
+def queue_email(msg):
+    """
+    Saves an EmailMultiAlternatives to be sent later
+    """
+    html = ''
+    for content, mimetype in getattr(msg, 'alternatives', []):
+        if mimetype == 'text/html': html = content
+    OutgoingEmail(subject=msg.subject, from_email=msg.from_email,
+                  to=','.join(msg.to), text_content=msg.body,
+                  html_content=html).save()
+
+def message(email):
+    """
+    Turns a queued OutgoingEmail back into something that can be sent
+    """
+    msg = EmailMultiAlternatives(email.subject, email.text_content,
+                                 email.from_email, email.to.split(','))
+    if email.html_content: msg.attach_alternative(email.html_content, "text/html")
+    return msg
+
+def claim(batch_size):
+    """
+    Takes up to batch_size of the emails that are due for this worker.
+    Returns None if nothing is due and an empty list if other workers
+    took everything first
+    """
+    now = datetime.now()
+    due = OutgoingEmail.objects.filter(status='Q', next_attempt__lte=now)
+    ids = list(due.order_by('next_attempt').values_list('id', flat=True)[:batch_size])
+    if not ids: return None
+    token = "%s:%d:%s" % (gethostname(), os.getpid(), uuid4().hex)
+    # Whoever's UPDATE changes a row gets to send it. Pushing next_attempt
+    # out means a worker that dies lets the emails go to someone else later
+    OutgoingEmail.objects.filter(id__in=ids, status='Q', next_attempt__lte=now)\
+                         .update(claimed_by=token,
+                                 next_attempt=now + timedelta(seconds=CLAIM_SECONDS))
+    transaction.commit_unless_managed()
+    return list(OutgoingEmail.objects.filter(id__in=ids, claimed_by=token))
+
+def retry_delay(attempts):
+    """
+    Seconds to wait before trying an email again after attempts failures
+    """
+    delay = getattr(settings, 'EMAIL_RETRY_DELAY', 60)
+    return delay * 2 ** (attempts - 1)
+
+def _sent(email):
+    OutgoingEmail.objects.filter(id=email.id).update(status='S',
+        sent=datetime.now(), attempts=email.attempts + 1, error='')
+    transaction.commit_unless_managed()
+
+def _failed(email, error):
+    attempts = email.attempts + 1
+    if attempts >= getattr(settings, 'EMAIL_MAX_ATTEMPTS', 6): status = 'F'
+    else: status = 'Q'
+    next_attempt = datetime.now() + timedelta(seconds=retry_delay(attempts))
+    OutgoingEmail.objects.filter(id=email.id).update(status=status,
+        attempts=attempts, next_attempt=next_attempt, error=unicode(error))
+    transaction.commit_unless_managed()
+
+def _open(smtp):
+    # the stand-in used while testing has nothing to open or close
+    if hasattr(smtp, 'open'): smtp.open()
+
+def _close(smtp):
+    if hasattr(smtp, 'close'):
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+def send_batch(emails, connection_class=None):
+    """
+    Sends emails over a single SMTP connection. If one fails it is put
+    back to be retried later and a fresh connection is opened for the rest.
+    Returns (number sent, number failed)
+    """
+    smtp = (connection_class or mail.SMTPConnection)()
+    is_open = False
+    sent = failed = 0
+    try:
+        for email in emails:
+            try:
+                if not is_open:
+                    _open(smtp)
+                    is_open = True
+                smtp.send_messages([message(email)])
+            except Exception as e:
+                _failed(email, e)
+                failed += 1
+                _close(smtp)
+                is_open = False
+            else:
+                _sent(email)
+                sent += 1
+    finally:
+        if is_open: _close(smtp)
+    return sent, failed
+
+def drain(threads=None, batch_size=None, connection_class=None):
+    """
+    Sends every email that is due, using a pool of threads which each
+    claim a batch at a time. Returns (number sent, number failed)
+    """
+    if threads is None: threads = getattr(settings, 'EMAIL_WORKER_THREADS', 4)
+    if batch_size is None: batch_size = getattr(settings, 'EMAIL_BATCH_SIZE', 50)
+    totals = [0, 0]
+    lock = Lock()
+    def work():
+        while True:
+            batch = claim(batch_size)
+            if batch is None: break
+            sent, failed = send_batch(batch, connection_class)
+            lock.acquire()
+            try:
+                totals[0] += sent
+                totals[1] += failed
+            finally:
+                lock.release()
+    def work_in_thread():
+        try:
+            work()
+        finally:
+            # every thread gets its own database connection
+            connection.close()
+    if threads <= 1:
+        work()
+    else:
+        pool = [Thread(target=work_in_thread) for i in range(threads)]
+        for thread in pool: thread.start()
+        for thread in pool: thread.join()
+    return totals[0], totals[1]
@@ -0,0 +1,147 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+Cursor (keyset) pagination. Instead of counting the whole list and skipping
+to an OFFSET, each page remembers the sort values of its first and last rows
+and the next page starts with a WHERE on those values. Page 1000 costs the
+same as page 1 and the list is never counted.
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from django.db.models import Q
+from django.utils import simplejson
+
+class Key(object):
+    """
+    One column the list is sorted by. field can follow relations
+    the same way as in a filter, e.g. metabook__title
+    The column must never be NULL
+    """
+    def __init__(self, field, descending=False):
+        self.field = field
+        self.descending = descending
+
+    def prepare(self, queryset):
+        """ Hook for keys that need something added to the queryset """
+        return queryset
+
+    def ordering(self, reverse=False):
+        if self.descending != reverse: return '-%s' % self.field
+        return self.field
+
+    def value(self, obj):
+        for attr in self.field.split('__'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def equal(self, value):
+        return Q(**{self.field : value})
+
+    def beyond(self, value, reverse=False):
+        """ Rows that come after value (or before it if reverse is True) """
+        if self.descending != reverse: lookup = 'lt'
+        else: lookup = 'gt'
+        return Q(**{'%s__%s' % (self.field, lookup) : value})
+
+def encode_cursor(direction, values):
+    data = simplejson.dumps([direction] + [unicode(v) for v in values])
+    return urlsafe_b64encode(data.encode('utf-8'))
+
+def decode_cursor(token, num_keys):
+    """
+    Returns (direction, values) or None if the token is garbage
+    """
+    try:
+        data = simplejson.loads(urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(data, list) or len(data) != num_keys + 1 or \
+       data[0] not in ('next', 'prev'):
+        return None
+    return data[0], data[1:]
+
+class CursorPage(object):
+    """
+    Quacks enough like django's Page for the list templates
+    """
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+class CursorPaginator(object):
+    """
+    Pages through queryset sorted by keys. The id is always added as the
+    last key so that every row has a unique position
+    """
+    def __init__(self, queryset, keys, per_page):
+        self.keys = list(keys) + [Key('id')]
+        for key in self.keys:
+            queryset = key.prepare(queryset)
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def after(self, values, reverse=False):
+        """
+        Builds the WHERE for every row past values:
+        (k1 > v1) or (k1 = v1 and k2 > v2) or ...
+        """
+        q = equal = None
+        for key, value in zip(self.keys, values):
+            step = key.beyond(value, reverse)
+            if equal is not None: step = equal & step
+            q = step if q is None else q | step
+            if equal is None: equal = key.equal(value)
+            else: equal = equal & key.equal(value)
+        return q
+
+    def page(self, cursor=None):
+        reverse = False
+        queryset = self.queryset
+        decoded = cursor and decode_cursor(cursor, len(self.keys))
+        if decoded:
+            direction, values = decoded
+            reverse = direction == 'prev'
+            queryset = queryset.filter(self.after(values, reverse))
+        ordering = [key.ordering(reverse) for key in self.keys]
+        # extra(order_by=...) overrides any ordering already on the queryset
+        queryset = queryset.extra(order_by=ordering)
+        # Grab one extra row to find out if there's another page
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse: rows.reverse()
+        if not rows:
+            return CursorPage(rows, None, None)
+        first = [key.value(rows[0]) for key in self.keys]
+        last = [key.value(rows[-1]) for key in self.keys]
+        if reverse:
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = bool(decoded), more
+        next_cursor = previous_cursor = None
+        if has_next: next_cursor = encode_cursor('next', last)
+        if has_previous: previous_cursor = encode_cursor('prev', first)
+        return CursorPage(rows, next_cursor, previous_cursor)
+
+def iterate(queryset, keys, per_page=1000):
+    """
+    Yields every row of queryset sorted by keys, fetching per_page rows
+    at a time so that memory use stays the same however many there are
+    """
+    paginator = CursorPaginator(queryset, keys, per_page)
+    page = paginator.page()
+    while True:
+        for obj in page.object_list:
+            yield obj
+        if not page.has_next(): break
+        page = paginator.page(page.next_cursor)
@@ -0,0 +1,362 @@
+# Copyright (C) 2010  Trinity Western University
+
+from cube.books.models import MetaBook, Course, SearchGram, PrefixChange,\
+                              get_version, bump_version
+from bisect import bisect_left, insort
+from django.db import connection, transaction
+from django.db.models import Q
+from threading import Lock
+
+# The MetaBook fields that get chopped up into the search index
+INDEXED_FIELDS = ('title', 'author', 'barcode')
+
+# Length of each chunk in the index. Anything shorter can't use the index
+GRAM_LENGTH = 3
+
+def grams(text):
+    """
+    Returns the set of lowercase three letter chunks found in text
+    """
+    text = text.lower()
+    last = len(text) - GRAM_LENGTH + 1
+    return set([text[i:i + GRAM_LENGTH] for i in range(max(last, 0))])
+
+def metabook_grams(metabook):
+    """
+    Returns every chunk in the indexed fields of a metabook.
+    Fields are chopped up separately so no chunk spans two of them
+    """
+    found = set()
+    for field in INDEXED_FIELDS:
+        found |= grams(unicode(getattr(metabook, field)))
+    return found
+
+def _insert_grams(rows):
+    """
+    rows is a list of (gram, metabook_id) tuples
+    """
+    if not rows: return
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+        qn(SearchGram._meta.db_table), qn('gram'), qn('metabook_id'))
+    connection.cursor().executemany(sql, rows)
+
+def index_metabook(metabook):
+    """
+    Replaces the index entries of a single metabook
+    """
+    SearchGram.objects.filter(metabook=metabook).delete()
+    _insert_grams([(g, metabook.id) for g in metabook_grams(metabook)])
+    transaction.commit_unless_managed()
+
+def rebuild_index(batch_size=1000):
+    """
+    Throws away the whole index and builds it again from the MetaBook table
+    Returns the number of metabooks indexed
+    """
+    SearchGram.objects.all().delete()
+    count = 0
+    rows = []
+    fields = ('id',) + INDEXED_FIELDS
+    for values in MetaBook.objects.values_list(*fields).iterator():
+        metabook_id = values[0]
+        found = set()
+        for value in values[1:]:
+            found |= grams(unicode(value))
+        rows.extend([(g, metabook_id) for g in found])
+        count += 1
+        if len(rows) >= batch_size:
+            _insert_grams(rows)
+            rows = []
+    _insert_grams(rows)
+    transaction.commit_unless_managed()
+    return count
+
+def metabooks(filter, fields=INDEXED_FIELDS):
+    """
+    Returns a query for the MetaBooks where any of fields contains filter,
+    ignoring case, just like an icontains lookup would. It is meant to be
+    used as a subquery so the matching ids never leave the database.
+    Returns None if filter is too short to be looked up in the index
+    """
+    needed = list(grams(filter))
+    if not needed:
+        return None
+    # Only metabooks that have every chunk of the filter can possibly match
+    qn = connection.ops.quote_name
+    candidates = "%s.%s IN (SELECT %s FROM %s WHERE %s IN (%s) "\
+                 "GROUP BY %s HAVING COUNT(*) = %d)" % (
+        qn(MetaBook._meta.db_table), qn('id'), qn('metabook_id'),
+        qn(SearchGram._meta.db_table), qn('gram'),
+        ', '.join(['%s'] * len(needed)), qn('metabook_id'), len(needed))
+    # Chunks can be out of order, so double check the candidates
+    q = Q()
+    for field in fields:
+        q = q | Q(**{'%s__icontains' % field : filter})
+    return MetaBook.objects.extra(where=[candidates], params=needed).filter(q)
+
+def course_metabooks(filter):
+    """
+    Returns a query for the MetaBooks with a course matching every word of
+    filter, numbers against the course number and words against the
+    department. Returns None if filter has no words, which matches anything
+    """
+    found = None
+    for word in filter.split():
+        try:
+            int(word)
+            courses = Course.objects.filter(number__icontains=word)
+        except ValueError:
+            courses = Course.objects.filter(department__icontains=word)
+        if found is None: found = MetaBook.objects.all()
+        # each filter() joins the courses again, so the words can match
+        # different courses of the same metabook
+        found = found.filter(courses__in=courses)
+    return found
+
+# Kept in place of results too big to be worth keeping
+TOO_MANY = 'too many'
+
+class ResultCache(object):
+    """
+    Least recently used cache of the book ids found by recent searches.
+    Everything in it is thrown away as soon as the data version it was
+    filled at goes out of date
+    """
+    def __init__(self, size=500, max_results=500):
+        self.size = size
+        # Bigger results aren't worth keeping, an IN list that long is
+        # no faster than running the search again. It also has to stay
+        # well under SQLite's limit of 999 parameters a query
+        self.max_results = max_results
+        self.version = None
+        self.entries = {}
+        self.tick = 0
+        self.hits = self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key, version):
+        self.lock.acquire()
+        try:
+            if version != self.version:
+                self.entries = {}
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tick += 1
+            self.entries[key] = (self.tick, entry[1])
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def set(self, key, version, ids):
+        # remembering that a search finds too many saves looking again
+        if ids is not TOO_MANY and len(ids) > self.max_results: ids = TOO_MANY
+        self.lock.acquire()
+        try:
+            if version != self.version:
+                # the data changed while the search was running
+                return
+            if len(self.entries) >= self.size and not self.entries.has_key(key):
+                oldest = min(self.entries.items(), key=lambda x: x[1][0])[0]
+                del self.entries[oldest]
+            self.tick += 1
+            self.entries[key] = (self.tick, ids)
+        finally:
+            self.lock.release()
+
+# Shared by every request this process serves
+results = ResultCache()
+
+# Name of the DataVersion bumped whenever a MetaBook or Course changes
+METABOOKS_VERSION = 'metabooks'
+
+def prefix_keys(text):
+    """
+    The lowercase keys text can be found under: the whole text and
+    the rest of it from the start of each later word
+    """
+    words = text.lower().split()
+    keys = [' '.join(words[i:]) for i in range(len(words))]
+    return [key for key in keys if key]
+
+class PrefixIndex(object):
+    """
+    Sorted array of (key, label, metabook id) used to suggest titles,
+    authors, barcodes and course codes as they are typed.
+    Lookups are a bisect, and changes to single metabooks are applied
+    in place rather than rebuilding the whole array, including the ones
+    other processes made
+    """
+    def __init__(self):
+        self.entries = []
+        self.by_metabook = {}
+        self.version = None
+        # guards entries and by_metabook
+        self.lock = Lock()
+        # held while bringing the index up to a new version
+        self.updating = Lock()
+
+    def metabook_entries(self, id, title, author, barcode):
+        entries = []
+        for text in (title, author):
+            entries.extend([(key, text, id) for key in prefix_keys(text)])
+        entries.append((barcode.lower(), barcode, id))
+        return entries
+
+    def course_entries(self, code):
+        return [(key, code, None) for key in prefix_keys(code)]
+
+    def build(self):
+        entries = []
+        by_metabook = {}
+        fields = ('id', 'title', 'author', 'barcode')
+        for values in MetaBook.objects.values_list(*fields).iterator():
+            found = self.metabook_entries(*values)
+            by_metabook[values[0]] = found
+            entries.extend(found)
+        for course in Course.objects.all():
+            entries.extend(self.course_entries(course.code()))
+        entries.sort()
+        self.lock.acquire()
+        try:
+            self.entries = entries
+            self.by_metabook = by_metabook
+        finally:
+            self.lock.release()
+
+    def _remove(self, entry):
+        i = bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def update_metabook(self, id, metabook=None):
+        """
+        Swaps the entries of metabook id for ones from metabook, or just
+        takes them out if it has been deleted
+        """
+        self.lock.acquire()
+        try:
+            for entry in self.by_metabook.pop(id, []):
+                self._remove(entry)
+            if metabook is None: return
+            found = self.metabook_entries(id, metabook.title,
+                                          metabook.author, metabook.barcode)
+            self.by_metabook[id] = found
+            for entry in found:
+                insort(self.entries, entry)
+        finally:
+            self.lock.release()
+
+    def update_course(self, old_code, code=None):
+        """
+        Swaps the entries of the course which was called old_code for
+        ones under code. Either can be None for added or deleted courses
+        """
+        self.lock.acquire()
+        try:
+            if old_code is not None:
+                for entry in self.course_entries(old_code):
+                    self._remove(entry)
+            if code is not None:
+                for entry in self.course_entries(code):
+                    i = bisect_left(self.entries, entry)
+                    if i == len(self.entries) or self.entries[i] != entry:
+                        self.entries.insert(i, entry)
+        finally:
+            self.lock.release()
+
+    def suggest(self, prefix, limit=10):
+        """
+        Returns up to limit distinct labels with a key starting with prefix
+        """
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix: return []
+        labels = []
+        self.lock.acquire()
+        try:
+            entries = self.entries
+            i = bisect_left(entries, (prefix,))
+            while i < len(entries) and len(labels) < limit:
+                key, label, id = entries[i]
+                if not key.startswith(prefix): break
+                if label not in labels: labels.append(label)
+                i += 1
+        finally:
+            self.lock.release()
+        return labels
+
+    def catch_up(self, version):
+        """
+        Brings the index up to version by applying the PrefixChanges made
+        since, rebuilding it only if some of them are no longer kept
+        """
+        self.updating.acquire()
+        try:
+            if self.version == version: return
+            changes = []
+            if self.version is not None and self.version < version:
+                changes = PrefixChange.objects.filter(version__gt=self.version,
+                                                      version__lte=version)
+                changes = list(changes.order_by('version'))
+            if changes and len(changes) == version - self.version:
+                ids = [c.metabook_id for c in changes if c.metabook_id]
+                metabooks = MetaBook.objects.in_bulk(ids)
+                for change in changes:
+                    if change.metabook_id:
+                        self.update_metabook(change.metabook_id,
+                                             metabooks.get(change.metabook_id))
+                    if change.old_code or change.code:
+                        self.update_course(change.old_code, change.code)
+            else:
+                self.build()
+            self.version = version
+        finally:
+            self.updating.release()
+
+# Shared by every request this process serves
+prefixes = PrefixIndex()
+
+# How many PrefixChanges are kept for processes that are behind. Ones
+# further behind than this rebuild their index
+KEEP_CHANGES = 1000
+
+def suggest(prefix, limit=10):
+    """
+    Suggestions for what is being typed into the search box.
+    Changes other processes made to the metabooks are applied first
+    """
+    version = get_version(METABOOKS_VERSION)
+    if version != prefixes.version: prefixes.catch_up(version)
+    return prefixes.suggest(prefix, limit)
+
+def metabooks_changed(metabook=None, course=None, deleted=False,
+                      old_code=None):
+    """
+    Applies a change to the prefix index of this process and stores it
+    for the other processes to apply to theirs. old_code is what a
+    changed course used to be called, None if it is new
+    """
+    bump_version(METABOOKS_VERSION)
+    version = get_version(METABOOKS_VERSION)
+    change = PrefixChange(version=version, old_code=old_code)
+    if metabook is not None:
+        change.metabook_id = metabook.id
+        if deleted: metabook = None
+    if course is not None and not deleted: change.code = course.code()
+    change.save()
+    PrefixChange.objects.filter(version__lte=version - KEEP_CHANGES).delete()
+    prefixes.updating.acquire()
+    try:
+        if prefixes.version != version - 1:
+            # out of date already, the next suggest() catches up anyway
+            return
+        if change.metabook_id:
+            prefixes.update_metabook(change.metabook_id, metabook)
+        if course is not None: prefixes.update_course(old_code, change.code)
+        prefixes.version = version
+    finally:
+        prefixes.updating.release()
@@ -0,0 +1,2 @@
+-- Hold expiry looks for status = 'O' and an old hold_date
+CREATE INDEX books_book_status_hold_date ON books_book (status, hold_date);
@@ -0,0 +1,2 @@
+-- The user report lists the actions of a user in order, see reports.user
+CREATE INDEX books_log_who_when ON books_log (who_id, `when`);
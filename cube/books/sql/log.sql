@@ -0,0 +1,2 @@
+-- Finds log entries by the change they made, see bad_unholds
+CREATE INDEX books_log_action_from_status ON books_log (action, from_status);
@@ -155,7 +155,13 @@ class HoldGlitchTest(TestCase):
                             status_code=400)
 
 from django.core import mail
+from cube.books.outbox import drain
 class EmailTest(TestCase):
+    """
+    The books are posted as idToEdit, the name of the book list's
+    checkboxes and the key update_book reads. Emails are queued, so the
+    outbox is drained before it is looked at
+    """
     fixtures = ['test_3_for_sale.json']
     def setUp(self):
         self.client.login(username=STAFF_USERNAME, password=PASSWORD)
@@ -168,28 +174,31 @@ class EmailTest(TestCase):
     def test_sold(self):
         """ Ensure that an email is sent when a book is sold """
         post_data = {
-            'idToEdit1' : '1',
+            'idToEdit' : '1',
             'Action' : 'Sold',
         }
         response = self.client.post('/books/update/book/', post_data)
+        drain(threads=1)
         self.assertEquals(len(mail.outbox), 1)
     def test_missing(self):
         """ Ensure that an email is sent when a book goes missing """
         post_data = {
-            'idToEdit1' : '1',
+            'idToEdit' : '1',
             'Action' : 'Missing',
         }
         response = self.client.post('/books/update/book/', post_data)
+        drain(threads=1)
         self.assertEquals(len(mail.outbox), 1)
     def test_tobodeleted(self):
         """
         Ensure that an email is send when a book is marted as to be deleted
         """
         post_data = {
-            'idToEdit1' : '1',
+            'idToEdit' : '1',
             'Action' : 'To Be Deleted',
         }
         response = self.client.post('/books/update/book/', post_data)
+        drain(threads=1)
         self.assertEquals(len(mail.outbox), 1)
 
 class AddNewBookTest(TestCase):
@@ -552,3 +561,920 @@ class NotAllowedTest(TestCase):
     def test_metabooks_update(self):
         response = self.client.get('/metabooks/update/')
         self.assertContains(response, 'which is not allowed.', status_code=405)
+
+class BookListStatusTest(TestCase):
+    """
+    The status ordering and for sale visibility on the book list
+    are done by the database rather than in python
+    """
+    fixtures = ['test_3_for_sale.json']
+    def test_staff_order(self):
+        """ Staff see unsold books first """
+        Book.objects.filter(pk=1).update(status='S')
+        Book.objects.filter(pk=2).update(status='O')
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        response = self.client.get('/books/')
+        books = response.context['books'].object_list
+        self.assertEquals([b.id for b in books], [3, 2, 1])
+    def test_student_for_sale_only(self):
+        """ Students only see books which are for sale """
+        Book.objects.filter(pk=1).update(status='S')
+        self.client.login(username=TEST_USERNAME, password=PASSWORD)
+        response = self.client.get('/books/')
+        books = response.context['books'].object_list
+        self.assertEquals([b.id for b in books], [2, 3])
+
+from cube.books.views.tools import book_filter
+class SearchIndexTest(TestCase):
+    """
+    The search index has to give the same results as the LIKE queries
+    """
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        # fixtures don't fire post_save, so build the index by hand
+        from cube.books.search import rebuild_index
+        rebuild_index()
+    def compare(self, filter, field='any_field'):
+        books = Book.objects.all()
+        indexed = book_filter(filter, field, books)
+        scanned = book_filter(filter, field, books, indexed=False)
+        self.assertEquals(sorted([b.id for b in indexed]),
+                          sorted([b.id for b in scanned]))
+        return indexed
+    def test_middle_of_title(self):
+        """ Substrings in the middle of a title are found """
+        self.assertEquals([b.id for b in self.compare('marill')], [1])
+    def test_case(self):
+        """ Searching ignores case """
+        self.assertEquals([b.id for b in self.compare('ROGUE')], [2])
+    def test_fields(self):
+        """ Every field gives the same results as before """
+        for filter in ('tolkien', '97805', 'ALDR 123', 'for sale', '3', 'xyz'):
+            self.compare(filter)
+        self.compare('church', 'title')
+        self.compare('barth', 'author')
+        self.compare('0618', 'barcode')
+    def test_edit_updates_index(self):
+        """ Saving a metabook updates the index """
+        metabook = MetaBook.objects.get(pk=1)
+        metabook.title = 'The Hobbit'
+        metabook.save()
+        self.assertEquals([b.id for b in self.compare('hobbit')], [1])
+        self.assertEquals(list(self.compare('marill')), [])
+
+class CursorPaginationTest(TestCase):
+    """
+    Walks the book list one book at a time with cursor pagination
+    """
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+    def walk(self, get_data):
+        get_data['per_page'] = 1
+        get_data['cursor'] = ''
+        seen = []
+        while True:
+            response = self.client.get('/books/', get_data)
+            page = response.context['books']
+            seen.extend([b.id for b in page.object_list])
+            if not page.has_next(): break
+            get_data['cursor'] = page.next_cursor
+        # and make sure we can get back again
+        previous = self.client.get('/books/', get_data).context['books']
+        get_data['cursor'] = previous.previous_cursor
+        back = self.client.get('/books/', get_data).context['books']
+        self.assertEquals([b.id for b in back.object_list], [seen[-2]])
+        return seen
+    def test_default(self):
+        """ Cursor pages come in the same order as the normal list """
+        Book.objects.filter(pk=1).update(status='S')
+        self.assertEquals(self.walk({}), [2, 3, 1])
+    def test_sorted(self):
+        """ Cursor pages follow the chosen sort column """
+        get_data = {'sort_by' : 'price', 'dir' : 'desc'}
+        self.assertEquals(self.walk(get_data), [1, 2, 3])
+    def test_default_mode(self):
+        """ The list is cursor paginated unless a page number is given """
+        response = self.client.get('/books/')
+        self.failUnless(response.context['cursor_mode'])
+        response = self.client.get('/books/', {'page' : 1})
+        self.failIf(response.context['cursor_mode'])
+    def test_other_lists_default_mode(self):
+        """ The metabook and staff lists are cursor paginated by default too """
+        for url in ('/metabooks/', '/staff/'):
+            response = self.client.get(url)
+            self.failUnless(response.context['cursor_mode'])
+            response = self.client.get(url, {'page' : 1})
+            self.failIf(response.context['cursor_mode'])
+
+from django.conf import settings
+from django.db import connection
+from cube.books.models import load_courses
+class LoadCoursesTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.old_debug = settings.DEBUG
+        # queries are only recorded while DEBUG is on
+        settings.DEBUG = True
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+    def test_one_query(self):
+        """ Course codes for a whole list come from one query """
+        metabooks = list(MetaBook.objects.all())
+        expected = [m.course_codes() for m in metabooks]
+        metabooks = list(MetaBook.objects.all())
+        connection.queries = []
+        load_courses(metabooks)
+        codes = [m.course_codes() for m in metabooks]
+        self.assertEquals(len(connection.queries), 1)
+        self.assertEquals(codes, expected)
+
+class CourseListTest(TestCase):
+    fixtures = ['test_empty.json']
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+    def test_add_new_book(self):
+        """ Adding a new book stores its course list """
+        post_data = {
+            'barcode' : '9781590524756',
+            'seller' : '3',
+            'price' : '4.78',
+            'author' : 'Bruce Wilkinson',
+            'title' : 'The Prayer of Jabez',
+            'edition' : '1',
+            'department' : 'RELS',
+            'course_number' : '123',
+            'Action' : 'Add'
+        }
+        self.client.post('/add_new_book/', post_data)
+        metabook = MetaBook.objects.get(barcode='9781590524756')
+        self.assertEquals(metabook.course_list, 'RELS 123')
+    def test_update_course_list(self):
+        """ The stored list follows changes to the courses """
+        metabook = MetaBook(title='Title', author='Author', barcode='123',
+                            edition=1)
+        metabook.save()
+        metabook.courses.add(Course.objects.create(department='ENGL', number='103'))
+        metabook.courses.add(Course.objects.create(department='BIOL', number='101'))
+        metabook.update_course_list()
+        metabook = MetaBook.objects.get(pk=metabook.pk)
+        self.assertEquals(metabook.course_list, 'BIOL 101, ENGL 103')
+        self.assertEquals(metabook.course_codes(), 'BIOL 101, ENGL 103')
+    def test_course_renamed(self):
+        """ Renaming a course updates the lists it is stored in """
+        metabook = MetaBook(title='Title', author='Author', barcode='123',
+                            edition=1)
+        metabook.save()
+        course = Course.objects.create(department='ENGL', number='103')
+        metabook.courses.add(course)
+        metabook.update_course_list()
+        course.number = '104'
+        course.save()
+        metabook = MetaBook.objects.get(pk=metabook.pk)
+        self.assertEquals(metabook.course_list, 'ENGL 104')
+        course.delete()
+        self.assertEquals(MetaBook.objects.get(pk=metabook.pk).course_list, '')
+    def test_long_list(self):
+        """ Books on too many courses to fit keep as many whole codes as fit """
+        metabook = MetaBook(title='Title', author='Author', barcode='123',
+                            edition=1)
+        metabook.save()
+        for number in range(100, 160):
+            metabook.courses.add(Course.objects.create(department='ENGL',
+                                                       number=str(number)))
+        metabook.update_course_list()
+        stored = MetaBook.objects.get(pk=metabook.pk).course_list
+        self.failUnless(len(stored) <= 250)
+        self.failUnless(stored.endswith('ENGL 124'))
+
+from cube.books import search
+from cube.books.views.tools import cached_book_filter
+from cube.books.models import get_version, BOOKS_VERSION
+class ResultCacheTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        search.results.entries = {}
+    def test_hit(self):
+        """ A repeated search is answered from the cache """
+        hits = search.results.hits
+        cached_book_filter('Rogue', 'title', False)
+        ids = [b.id for b in cached_book_filter('rogue', 'title', False)]
+        self.assertEquals(ids, [2])
+        self.assertEquals(search.results.hits, hits + 1)
+    def test_invalidated_by_update(self):
+        """ Changing books in bulk throws away cached results """
+        self.assertEquals(len(cached_book_filter('rogue', 'title', False)), 1)
+        Book.objects.filter(pk=2).update(status='S')
+        self.assertEquals(len(cached_book_filter('rogue', 'title', False)), 0)
+    def test_invalidated_by_save(self):
+        """ Saving a metabook throws away cached results """
+        self.assertEquals(len(cached_book_filter('hobbit', 'title', True)), 0)
+        metabook = MetaBook.objects.get(pk=1)
+        metabook.title = 'The Hobbit'
+        metabook.save()
+        self.assertEquals(len(cached_book_filter('hobbit', 'title', True)), 1)
+    def test_lru(self):
+        """ The least recently used entry is dropped when the cache is full """
+        cache = search.ResultCache(size=2)
+        cache.get('a', 1)
+        cache.set('a', 1, [1])
+        cache.set('b', 1, [2])
+        cache.get('a', 1)
+        cache.set('c', 1, [3])
+        self.assertEquals(cache.get('a', 1), [1])
+        self.assertEquals(cache.get('b', 1), None)
+    def test_too_many(self):
+        """ Big results are searched for in the database every time """
+        old_max = search.results.max_results
+        search.results.max_results = 2
+        try:
+            books = cached_book_filter('for sale', 'status', True)
+            self.assertEquals(len(books), 3)
+            version = get_version(BOOKS_VERSION)
+            key = ('for sale', 'status', True)
+            self.failUnless(search.results.get(key, version) is search.TOO_MANY)
+            self.assertEquals(len(cached_book_filter('for sale', 'status', True)), 3)
+        finally:
+            search.results.max_results = old_max
+
+from django.utils import simplejson
+class SuggestTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        # force a rebuild from the fixture
+        search.prefixes.version = None
+    def suggest(self, q):
+        response = self.client.get('/books/suggest/', {'q' : q})
+        self.failUnlessEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+    def test_prefixes(self):
+        """ Titles, authors, barcodes and courses are suggested """
+        self.assertEquals(self.suggest('silm'), ['The Silmarillion'])
+        self.assertEquals(self.suggest('the s'), ['The Silmarillion'])
+        self.assertEquals(self.suggest('Barth'), ['Karl Barth'])
+        self.assertEquals(self.suggest('97800619'), ['9780061939891'])
+        self.assertEquals(self.suggest('anth'), ['ANTH 123'])
+    def test_incremental(self):
+        """ Saving a metabook updates the suggestions in place """
+        self.suggest('silm')
+        metabook = MetaBook.objects.get(pk=1)
+        metabook.title = 'The Hobbit'
+        metabook.save()
+        self.assertEquals(self.suggest('silm'), [])
+        self.assertEquals(self.suggest('hob'), ['The Hobbit'])
+    def test_course_renamed(self):
+        """ A renamed course is only suggested under its new code """
+        self.suggest('anth')
+        course = Course.objects.get(pk=2)
+        course.department = 'ARTS'
+        course.save()
+        self.assertEquals(self.suggest('anth'), [])
+        self.assertEquals(self.suggest('arts'), ['ARTS 123'])
+        course.delete()
+        self.assertEquals(self.suggest('arts'), [])
+    def test_unchanged_save(self):
+        """ Saving a metabook without changing it leaves the index alone """
+        self.suggest('silm')
+        version = search.get_version(search.METABOOKS_VERSION)
+        metabook = MetaBook.objects.get(pk=1)
+        metabook.edition = 2
+        metabook.save()
+        self.assertEquals(search.get_version(search.METABOOKS_VERSION), version)
+    def test_other_process(self):
+        """ Changes made by other processes are applied without a rebuild """
+        self.suggest('silm')
+        ours = search.prefixes
+        # the change is made by another process with its own index
+        search.prefixes = search.PrefixIndex()
+        try:
+            metabook = MetaBook.objects.get(pk=1)
+            metabook.title = 'The Hobbit'
+            metabook.save()
+            course = Course.objects.get(pk=2)
+            course.department = 'ARTS'
+            course.save()
+        finally:
+            search.prefixes = ours
+        def build():
+            self.fail("the index was rebuilt")
+        ours.build = build
+        try:
+            self.assertEquals(self.suggest('silm'), [])
+            self.assertEquals(self.suggest('hob'), ['The Hobbit'])
+            self.assertEquals(self.suggest('arts'), ['ARTS 123'])
+        finally:
+            del ours.build
+
+from cube.books.isbn import to_isbn13, InvalidISBN
+class ISBNTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_convert(self):
+        """ ISBN-10s become ISBN-13s """
+        self.assertEquals(to_isbn13('0-618-39111-8'), '9780618391110')
+        self.assertEquals(to_isbn13('080442957x'), '9780804429573')
+        self.assertEquals(to_isbn13('9780618391110'), '9780618391110')
+        self.assertEquals(to_isbn13('12345'), None)
+    def test_check_digit(self):
+        """ ISBNs with a wrong check digit are refused """
+        self.assertRaises(InvalidISBN, to_isbn13, '9780618391111')
+        self.assertRaises(InvalidISBN, to_isbn13, '0618391117')
+    def test_add_isbn10(self):
+        """ Scanning the ISBN-10 of a book finds its ISBN-13 MetaBook """
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        post_data = {'seller' : '3', 'price' : '5.00', 'barcode' : '0618391118'}
+        response = self.client.post('/add_book/', post_data)
+        self.assertContains(response, 'The Silmarillion')
+        self.assertEquals(Book.objects.filter(metabook=1).count(), 2)
+    def test_search_isbn10(self):
+        """ Searching for the ISBN-10 of a book finds it """
+        books = book_filter('0-618-39111-8', 'barcode', Book.objects.all())
+        self.assertEquals([b.id for b in books], [1])
+    def test_bad_stored_barcode(self):
+        """ Books stored under a bad check digit can still be scanned """
+        MetaBook.objects.filter(pk=1).update(barcode='9780618391111')
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        post_data = {'seller' : '3', 'price' : '5.00', 'barcode' : '978-0618391111'}
+        response = self.client.post('/add_book/', post_data)
+        self.assertContains(response, 'The Silmarillion')
+        post_data['barcode'] = '9780061939892'
+        response = self.client.post('/add_book/', post_data)
+        self.failUnless(response.context['form'].errors.has_key('barcode'))
+
+from cube.books.models import acquire_lease, release_lease
+class LeaseTest(TestCase):
+    fixtures = ['test_empty.json']
+    def test_one_holder(self):
+        """ Only one worker can hold a lease at a time """
+        self.assertTrue(acquire_lease('job', 'a', 60))
+        self.assertFalse(acquire_lease('job', 'b', 60))
+        # the holder can renew it
+        self.assertTrue(acquire_lease('job', 'a', 60))
+        release_lease('job', 'a')
+        self.assertTrue(acquire_lease('job', 'b', 60))
+    def test_expired(self):
+        """ An expired lease can be taken over """
+        self.assertTrue(acquire_lease('job', 'a', -1))
+        self.assertTrue(acquire_lease('job', 'b', 60))
+
+from cube.books.models import Log
+from cube.books.views.tools import expire_holds
+from datetime import datetime, timedelta
+class ExpireHoldsTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_expire(self):
+        """ Old holds are expired and logged, newer ones are left alone """
+        now = datetime.now()
+        Book.objects.filter(pk=1).update(status='O', holder=3,
+                                         hold_date=now - timedelta(days=2))
+        Book.objects.filter(pk=2).update(status='O', holder=3, hold_date=now)
+        self.assertEquals(expire_holds(batch_size=1), 1)
+        self.assertEquals(Book.objects.get(pk=1).status, 'F')
+        self.assertEquals(Book.objects.get(pk=2).status, 'O')
+        logs = Log.objects.filter(action='R')
+        self.assertEquals([(l.book.id, l.who.id) for l in logs], [(1, 3)])
+        # nothing more to do the second time around
+        self.assertEquals(expire_holds(), 0)
+    def test_removed_meanwhile(self):
+        """ Holds removed after they were found due aren't logged again """
+        from cube.books.views.tools import _expire_batch
+        yester = datetime.now() - timedelta(days=1)
+        Book.objects.filter(pk=1).update(status='O', holder=3,
+                                         hold_date=yester - timedelta(days=1))
+        # book 3 stands in for a hold staff removed after it was looked up
+        self.assertEquals(_expire_batch([(1, 3), (3, 3)], yester), 1)
+        self.assertEquals([l.book.id for l in Log.objects.filter(action='R')], [1])
+
+from cube.books.views.tools import warn_annual_sellers
+class WarnSellersTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_warn(self):
+        """ Year old books are marked To Be Deleted and logged """
+        Book.objects.filter(pk=1).update(
+            list_date=datetime.now() - timedelta(days=400))
+        warn_annual_sellers()
+        self.assertEquals(Book.objects.get(pk=1).status, 'T')
+        logs = Log.objects.filter(action='T')
+        self.assertEquals([(l.book.id, l.from_status, l.to_status) for l in logs],
+                          [(1, 'F', 'T')])
+
+from cube.books import transitions
+class TransitionTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+    def test_sold(self):
+        """ Selling several books at once logs each of them """
+        post_data = {'idToEdit' : ['1', '2', '3'], 'Action' : 'Sold'}
+        response = self.client.post('/books/update/book/', post_data)
+        self.assertEquals(Book.objects.filter(status='S').count(), 3)
+        logs = Log.objects.filter(action='S').order_by('book')
+        self.assertEquals([l.book.id for l in logs], [1, 2, 3])
+        drain(threads=1)
+        self.failUnless(len(mail.outbox) >= 1)
+    def test_not_allowed(self):
+        """ Books that can't make the transition are left alone """
+        Book.objects.filter(pk=1).update(status='P')
+        staff = User.objects.get(username=STAFF_USERNAME)
+        moved = transitions.apply('Sold', [1, 2], staff)
+        self.assertEquals([row[0] for row in moved], [2])
+        self.assertEquals(Book.objects.get(pk=1).status, 'P')
+        self.assertEquals(Log.objects.filter(book=1).count(), 0)
+
+from django.db import connection
+from django.test import TransactionTestCase
+from threading import Thread
+class ConcurrentTransitions(object):
+    """
+    Lots of students trying to put the same books on hold at once.
+    Needs a real database server, sqlite's in-memory test database can't
+    be shared between threads, so ConcurrentHoldTest is only part of the
+    suite on other databases
+    """
+    fixtures = ['test_3_for_sale.json']
+    num_threads = 20
+    def race(self, action, ids):
+        """
+        Everybody applies action to ids at once. Returns the ids each of
+        them moved by user id
+        """
+        students = [User.objects.create_user('racer%d' % i,
+                                             'racer%d@example.com' % i,
+                                             PASSWORD)
+                    for i in range(self.num_threads)]
+        won = {}
+        def apply(student):
+            try:
+                moved = transitions.apply(action, ids, student)
+                won[student.id] = [row[0] for row in moved]
+            finally:
+                connection.close()
+        threads = [Thread(target=apply, args=(s,)) for s in students]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return won
+    def test_one_winner(self):
+        """ Every book ends up held by exactly one student """
+        ids = [1, 2, 3]
+        won = self.race('Place on Hold', ids)
+        winners = []
+        for student_ids in won.values(): winners.extend(student_ids)
+        self.assertEquals(sorted(winners), ids)
+        self.assertEquals(Log.objects.filter(action='O').count(), len(ids))
+        for book in Book.objects.filter(id__in=ids):
+            self.assertEquals(book.status, 'O')
+            self.failUnless(book.id in won[book.holder.id])
+    def test_deleted_once(self):
+        """ Books deleted by several people at once are logged once """
+        ids = [1, 2, 3]
+        won = self.race('Delete', ids)
+        winners = []
+        for student_ids in won.values(): winners.extend(student_ids)
+        self.assertEquals(sorted(winners), ids)
+        self.assertEquals(Log.objects.filter(action='D').count(), len(ids))
+
+if settings.DATABASE_ENGINE != 'sqlite3':
+    class ConcurrentHoldTest(ConcurrentTransitions, TransactionTestCase):
+        pass
+
+from cube.books.models import previous_statuses
+class UndeleteTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_undelete(self):
+        """ Deleted books go back to the status they had before """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1], staff)
+        transitions.apply('Missing', [2], staff)
+        transitions.apply('Delete', [1, 2], staff)
+        self.assertEquals(previous_statuses([1, 2]), {1 : 'S', 2 : 'M'})
+        self.assertEquals(transitions.undelete([1, 2, 3], staff), 2)
+        self.assertEquals(Book.objects.get(pk=1).status, 'S')
+        self.assertEquals(Book.objects.get(pk=2).status, 'M')
+        self.assertEquals(Log.objects.filter(action='U').count(), 2)
+    def test_old_logs(self):
+        """ Deletes logged without statuses go back to what the history implies """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        Log(action='S', book_id=1, who=staff).save()
+        Log(action='D', book_id=1, who=staff).save()
+        Book.objects.filter(pk=1).update(status='D')
+        self.assertEquals(previous_statuses([1]), {1 : 'S'})
+        transitions.undelete([1], staff)
+        self.assertEquals(Book.objects.get(pk=1).status, 'S')
+
+from cube.books.models import replay_statuses
+from django.core.management import call_command
+class LogStatusTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_transitions(self):
+        """ Every transition records the status it moved the book from """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Place on Hold', [1], staff)
+        transitions.apply('Sold', [1], staff)
+        logs = Log.objects.filter(book=1).order_by('id')
+        self.assertEquals([(l.from_status, l.to_status) for l in logs],
+                          [('F', 'O'), ('O', 'S')])
+        self.assertEquals(Book.objects.get(pk=1).status_at(logs[1].when), 'S')
+    def test_replay(self):
+        """ Undeleting goes back to the last real status """
+        self.assertEquals(replay_statuses(['A', 'O', 'D', 'U', 'E']),
+            [('', 'F'), ('F', 'O'), ('O', 'D'), ('D', 'O'), ('O', 'O')])
+    def test_backfill(self):
+        """ The backfill works the statuses out from the actions alone """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        for action in ('A', 'T', 'D'):
+            Log(action=action, book=Book.objects.get(pk=2), who=staff).save()
+        call_command('backfill_log_statuses')
+        logs = Log.objects.filter(book=2).order_by('id')
+        self.assertEquals([(l.from_status, l.to_status) for l in logs],
+                          [('', 'F'), ('F', 'T'), ('T', 'D')])
+        self.assertEquals(Book.objects.get(pk=2).previous_status(), 'T')
+
+from cube.books.models import OutgoingEmail
+from cube.books.outbox import queue_email
+from django.core.mail import EmailMultiAlternatives
+class FlakySMTPConnection(object):
+    """ Refuses every other email """
+    sends = 0
+    def send_messages(self, messages):
+        FlakySMTPConnection.sends += 1
+        if FlakySMTPConnection.sends % 2: raise IOError("connection lost")
+        mail.outbox.extend(messages)
+        return len(messages)
+
+class OutboxTest(TestCase):
+    fixtures = ['test_empty.json']
+    def queue(self, num):
+        for i in range(num):
+            msg = EmailMultiAlternatives('Subject %d' % i, 'Message',
+                                         'from@cube.com', ['to@example.com'])
+            msg.attach_alternative('<p>Message</p>', 'text/html')
+            queue_email(msg)
+    def test_queue(self):
+        """ Nothing is sent until the outbox is drained """
+        self.queue(3)
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(drain(threads=1, batch_size=2), (3, 0))
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertEquals(OutgoingEmail.objects.filter(status='S').count(), 3)
+        # and nothing is sent twice
+        self.assertEquals(drain(threads=1), (0, 0))
+    def test_retry(self):
+        """ Failed emails are put back with a delay """
+        FlakySMTPConnection.sends = 0
+        self.queue(2)
+        self.assertEquals(drain(1, 10, FlakySMTPConnection), (1, 1))
+        failed = OutgoingEmail.objects.get(status='Q')
+        self.assertEquals(failed.attempts, 1)
+        self.failUnless(failed.next_attempt > datetime.now())
+        # not due yet
+        self.assertEquals(drain(1, 10, FlakySMTPConnection), (0, 0))
+    def test_smtp_server(self):
+        """ Emails make it to a real SMTP server over one connection """
+        import asyncore, smtpd
+        received = []
+        class Server(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                received.append(rcpttos)
+        server = Server(('127.0.0.1', 0), None)
+        port = server.socket.getsockname()[1]
+        thread = Thread(target=asyncore.loop, kwargs={'timeout' : 0.1})
+        thread.start()
+        try:
+            self.queue(3)
+            def smtp():
+                return mail.original_SMTPConnection(host='127.0.0.1', port=port)
+            self.assertEquals(drain(1, 10, smtp), (3, 0))
+        finally:
+            server.close()
+            thread.join()
+        self.assertEquals(received, [['to@example.com']] * 3)
+
+from cube.appsettings.models import AppSetting
+from cube.books.email import owner_contexts
+class OwnerContextTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        AppSetting(name="Money Collection Hours", value="Mondays",
+                   description="").save()
+        self.old_debug = settings.DEBUG
+        settings.DEBUG = True
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+    def count_queries(self, ids):
+        connection.queries = []
+        owner_contexts(Book.objects.filter(id__in=ids))
+        return len(connection.queries)
+    def test_constant_queries(self):
+        """ More owners and books don't mean more queries """
+        few = self.count_queries([1])
+        Book.objects.filter(pk=2).update(seller=1)
+        Book.objects.filter(pk=3).update(seller=2)
+        self.assertEquals(self.count_queries([1, 2, 3]), few)
+    def test_context(self):
+        """ Each owner gets their own books and what they still sell """
+        Book.objects.filter(pk=3).update(seller=2)
+        contexts = dict([(owner.id, c) for owner, c in
+                         owner_contexts(Book.objects.filter(id__in=[1, 3]))])
+        self.assertEquals(contexts[3]['num_books'], 1)
+        self.assertEquals(len(contexts[3]['owner_selling']), 2)
+        self.assertEquals(len(contexts[2]['owner_selling']), 1)
+        self.assertEquals(contexts[2]['custom_msg'], "Mondays")
+
+from cube.books.email import send_sold_emails, send_missing_emails,\
+                             send_tbd_emails, send_digests, digest_savings
+class DigestTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        AppSetting(name="Money Collection Hours", value="Mondays",
+                   description="").save()
+        self.old_digest = getattr(settings, 'EMAIL_DIGEST', False)
+        settings.EMAIL_DIGEST = True
+    def tearDown(self):
+        settings.EMAIL_DIGEST = self.old_digest
+    def test_digest(self):
+        """ A seller gets one email for everything since the last digest """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1], staff, notify=send_sold_emails)
+        transitions.apply('Sold', [2], staff, notify=send_sold_emails)
+        transitions.apply('Missing', [3], staff, notify=send_missing_emails)
+        self.assertEquals(OutgoingEmail.objects.count(), 0)
+        self.assertEquals(send_digests(), 1)
+        email = OutgoingEmail.objects.get()
+        self.failUnless('sold' in email.html_content)
+        self.failUnless('missing' in email.html_content)
+        # one greeting and one signature around both sections
+        self.assertEquals(email.html_content.count('Dear'), 1)
+        self.assertEquals(email.html_content.count('sincerely'), 1)
+        self.assertEquals(digest_savings(), 2)
+        # everything was sent already
+        self.assertEquals(send_digests(), 0)
+    def test_list(self):
+        """ Notices can be saved for a list of books too """
+        send_tbd_emails(list(Book.objects.filter(id__in=[1, 2])))
+        self.assertEquals(send_digests(), 1)
+
+from cube.books.models import status_counts, count_statuses
+class StatusCountTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.old_counters = getattr(settings, 'STATUS_COUNTERS', False)
+        settings.STATUS_COUNTERS = True
+        call_command('check_status_counts', fix=True)
+    def tearDown(self):
+        settings.STATUS_COUNTERS = self.old_counters
+    def test_grouped(self):
+        """ All the statuses are counted by one query """
+        counts = count_statuses()
+        self.assertEquals(counts['F'], 3)
+        self.assertEquals(counts['S'], 0)
+    def test_counters(self):
+        """ The counters follow the books through every change """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1], staff)
+        transitions.apply('Delete', [1, 2], staff)
+        transitions.undelete([2], staff)
+        Book.objects.get(pk=3).delete()
+        self.assertEquals(status_counts(), count_statuses())
+        self.assertEquals(status_counts()['D'], 1)
+    def test_saved(self):
+        """ A status changed by saving the book, e.g. in the admin, is counted """
+        book = Book.objects.get(pk=1)
+        book.status = 'M'
+        book.save()
+        book.save()
+        self.assertEquals(status_counts(), count_statuses())
+        self.assertEquals(status_counts()['M'], 1)
+    def test_unknown_undelete(self):
+        """ Books deleted with no known status come back For Sale """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        Book.objects.filter(pk=1).update(status='D')
+        call_command('check_status_counts', fix=True)
+        transitions.undelete([1], staff)
+        self.assertEquals(Book.objects.get(pk=1).status, 'F')
+        self.assertEquals(status_counts(), count_statuses())
+
+class HoldsByUserTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def test_counts(self):
+        """ Holders are listed with the most holds first """
+        Book.objects.filter(pk__in=[1, 2]).update(status='O', holder=3)
+        Book.objects.filter(pk=3).update(status='O', holder=1)
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        response = self.client.get('/reports/holds_by_user/')
+        user_list = [(count, holder.id) for count, holder
+                     in response.context['user_list']]
+        self.assertEquals(user_list, [(2, 3), (1, 1)])
+    def test_pages(self):
+        """ Large numbers of holders are split into pages """
+        Book.objects.filter(pk=1).update(status='O', holder=1)
+        Book.objects.filter(pk=2).update(status='O', holder=2)
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        response = self.client.get('/reports/holds_by_user/?per_page=1&page=2')
+        self.assertEquals(len(response.context['user_list']), 1)
+        self.assertEquals(response.context['holders'].paginator.count, 2)
+
+class SalesExportTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1, 3], staff)
+        self.today = datetime.today().date()
+    def post(self, format):
+        post_data = {
+            'from_date' : self.today - timedelta(days=1),
+            'to_date' : self.today + timedelta(days=1),
+            'format' : format,
+        }
+        return self.client.post('/reports/books_sold_within_date/', post_data)
+    def test_csv(self):
+        """ Every sale is a line of the CSV file after the header """
+        response = self.post('csv')
+        self.assertEquals(response['Content-Type'], 'text/csv')
+        lines = response.content.splitlines()
+        self.assertEquals(len(lines), 3)
+        self.failUnless(lines[0].startswith('Ref,Title'))
+        self.assertEquals([line.split(',')[0] for line in lines[1:]], ['1', '3'])
+    def test_tsv(self):
+        """ TSV files are separated by tabs """
+        response = self.post('tsv')
+        self.failUnless(response.content.startswith('Ref\tTitle'))
+    def test_html(self):
+        """ The page still lists the books """
+        response = self.post('')
+        self.assertEquals([b.id for b in response.context['books_sold']], [1, 3])
+
+from cube.books.models import DailySales, rebuild_daily_sales,\
+                              add_daily_sales, remove_daily_sales
+class SalesRollupTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1, 3], staff)
+        self.today = datetime.today().date()
+    def totals(self):
+        return sorted([(d.day, d.department, d.books, d.revenue, d.sellers)
+                       for d in DailySales.objects.all()])
+    def test_incremental(self):
+        """ Selling books keeps the rollup for the day up to date """
+        books = Book.objects.filter(id__in=[1, 3])
+        self.assertEquals(sum([d.books for d in DailySales.objects.all()]), 2)
+        self.assertEquals(sum([d.revenue for d in DailySales.objects.all()]),
+                          sum([b.price for b in books]))
+        before = self.totals()
+        self.assertEquals(rebuild_daily_sales(), 1)
+        self.assertEquals(self.totals(), before)
+    def test_same_seller(self):
+        """ A seller selling again the same day is still one seller """
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [2], staff)
+        self.assertEquals(sum([d.sellers for d in DailySales.objects.all()]), 1)
+        before = self.totals()
+        rebuild_daily_sales()
+        self.assertEquals(self.totals(), before)
+    def test_price_edited(self):
+        """ Editing a sold book's price moves the revenue by the difference """
+        remove_daily_sales([1])
+        Book.objects.filter(pk=1).update(price='20.00')
+        add_daily_sales([1])
+        before = self.totals()
+        self.assertEquals(sum([d.revenue for d in DailySales.objects.all()]),
+                          Decimal('21.01'))
+        rebuild_daily_sales()
+        self.assertEquals(self.totals(), before)
+    def test_trend(self):
+        """ The trend report reads the rollup """
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        post_data = {
+            'from_date' : self.today - timedelta(days=7),
+            'to_date' : self.today,
+            'period' : 'week',
+        }
+        response = self.client.post('/reports/sales_trend/', post_data)
+        periods = response.context['periods']
+        self.assertEquals(len(periods), 1)
+        self.assertEquals(periods[0]['num_books'], 2)
+
+from django.utils.http import urlquote
+class UserReportTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        staff = User.objects.get(username=STAFF_USERNAME)
+        for id in (1, 2, 3):
+            transitions.apply('Place on Hold', [id], staff)
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+        self.url = '/reports/user/%d/' % staff.id
+    def test_pages(self):
+        """ The action log is paged through in order """
+        response = self.client.get(self.url + '?per_page=2')
+        self.assertEquals([l.book.id for l in response.context['logs']], [1, 2])
+        cursor = response.context['logs_page'].next_cursor
+        response = self.client.get(self.url, {'per_page' : 2, 'cursor' : cursor})
+        self.assertEquals([l.book.id for l in response.context['logs']], [3])
+    def test_both_pages(self):
+        """ Paging through one list keeps the other on its page """
+        Book.objects.update(seller=User.objects.get(username=STAFF_USERNAME))
+        response = self.client.get(self.url + '?per_page=2')
+        cursor = response.context['logs_page'].next_cursor
+        response = self.client.get(self.url, {'per_page' : 2, 'cursor' : cursor})
+        listed = response.context['listed_page'].next_cursor
+        self.failUnless('?cursor=%s&amp;listed=%s' % (urlquote(cursor),
+                        urlquote(listed)) in response.content)
+    def test_export(self):
+        """ The whole action log can be downloaded """
+        response = self.client.get(self.url + '?format=csv')
+        self.assertEquals(len(response.content.splitlines()), 4)
+
+from cube.books.models import PriceStats, refresh_price_stats,\
+                              update_price_stats
+from django.utils import simplejson
+class PriceStatsTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    def setUp(self):
+        # three copies of The Silmarillion at $11.31, $5.50 and $1.01
+        Book.objects.filter(id__in=[2, 3]).update(metabook=1)
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1, 2, 3], staff)
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+    def test_stats(self):
+        """ Selling books keeps the stats of their metabook up to date """
+        stats = PriceStats.objects.get(metabook=1)
+        self.assertEquals(stats.sold, 3)
+        self.assertEquals(stats.lowest, Decimal('1.01'))
+        self.assertEquals(stats.median, Decimal('5.50'))
+        self.assertEquals(stats.highest, Decimal('11.31'))
+        self.assertEquals(stats.suggested, Decimal('5.50'))
+        self.assertEquals(refresh_price_stats(days=0), 1)
+        self.assertEquals(PriceStats.objects.get(metabook=1).suggested,
+                          Decimal('5.50'))
+    def test_in_place(self):
+        """ Another sale updates the existing stats row """
+        before = PriceStats.objects.get(metabook=1)
+        Book.objects.filter(pk=3).update(price='20.00')
+        update_price_stats([1])
+        stats = PriceStats.objects.get(metabook=1)
+        self.assertEquals(stats.id, before.id)
+        self.assertEquals(stats.highest, Decimal('20.00'))
+    def test_moved(self):
+        """ A sold copy edited onto another title leaves the old one's stats """
+        post_data = {
+            'idToEdit' : '3',
+            'seller' : '3',
+            'price' : '1.01',
+            'barcode' : '9780061939891',
+        }
+        self.client.post('/books/update/book/edit/', post_data)
+        self.assertEquals(PriceStats.objects.get(metabook=1).sold, 2)
+        self.assertEquals(PriceStats.objects.get(metabook=2).sold, 1)
+    def test_quiet_not_refreshed(self):
+        """ Stats of books that haven't sold lately are left alone """
+        long_ago = datetime.now() - timedelta(days=365)
+        PriceStats.objects.update(recent_sales=0, last_sale=long_ago)
+        self.assertEquals(refresh_price_stats(days=0), 0)
+    def test_lookup(self):
+        """ Scanning a barcode gets the suggested price """
+        response = self.client.get('/books/price/', {'barcode' : '0618391118'})
+        self.assertEquals(simplejson.loads(response.content)['suggested'], '5.50')
+        response = self.client.get('/books/price/', {'barcode' : '9780061939891'})
+        self.assertEquals(simplejson.loads(response.content), {})
+    def test_user(self):
+        """ Students can't look up prices """
+        self.client.logout()
+        self.client.login(username=TEST_USERNAME, password=PASSWORD)
+        response = self.client.get('/books/price/', {'barcode' : '9780618391110'})
+        self.assertEquals(response.status_code, 403)
+
+class ConditionalGetTest(TestCase):
+    fixtures = ['test_3_for_sale.json']
+    pages = ('/books/', '/reports/', '/reports/per_status/',
+            '/reports/holds_by_user/')
+    def setUp(self):
+        self.client.login(username=STAFF_USERNAME, password=PASSWORD)
+    def etags(self):
+        return [self.client.get(url)['ETag'] for url in self.pages]
+    def test_not_modified(self):
+        """ Nothing changed since the last visit, so nothing is sent """
+        for url, etag in zip(self.pages, self.etags()):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304)
+    def test_changed(self):
+        """ Any change to the books sends the pages again """
+        before = self.etags()
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Place on Hold', [1], staff)
+        for url, etag in zip(self.pages, before):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 200)
+    def test_bumped_once(self):
+        """ A transition bumps the version once however many books it moves """
+        version = get_version(BOOKS_VERSION)
+        staff = User.objects.get(username=STAFF_USERNAME)
+        transitions.apply('Sold', [1, 2, 3], staff)
+        self.assertEquals(get_version(BOOKS_VERSION), version + 1)
+    def test_other_user(self):
+        """ Pages aren't shared between users """
+        etag = self.client.get('/books/')['ETag']
+        self.client.logout()
+        self.client.login(username=TEST_USERNAME, password=PASSWORD)
+        response = self.client.get('/books/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
@@ -0,0 +1,161 @@
+# Copyright (C) 2010  Trinity Western University
+
+"""
+Changes of book status done in bulk. TRANSITIONS says which statuses each
+action can be applied to, what the books become and what gets logged, and
+Transition.apply does it with one UPDATE and one Log insert
+"""
+
+from cube.books.models import Book, insert_logs, previous_statuses, lock_books,\
+                              count_status_changes, add_daily_sales,\
+                              update_price_stats, bump_version_once,\
+                              BOOKS_VERSION
+from django.db import transaction
+from datetime import datetime
+
+# Stand-ins for values only known when the transition is applied
+NOW = 'now'
+WHO = 'who'
+
+class Transition(object):
+    def __init__(self, allowed, status, log, contended=False, **updates):
+        """
+        allowed is a string of the statuses the books can be moved from,
+        status is the one they are moved to and log is the Log action.
+        updates are any other fields to set; NOW and WHO are replaced by
+        the time and the user applying the transition.
+        contended transitions are ones several users race each other for,
+        their books are updated one at a time so each one has one winner
+        """
+        self.allowed = allowed
+        self.status = status
+        self.log = log
+        self.contended = contended
+        self.updates = updates
+
+    def field_values(self, who, now):
+        values = {'status' : self.status}
+        for field, value in self.updates.items():
+            if value == NOW: value = now
+            elif value == WHO: value = who
+            values[field] = value
+        return values
+
+    def apply(self, ids, who, restrict=None, notify=None):
+        """
+        Moves the books in ids that are allowed to make this transition,
+        narrowed down further by the Q object restrict if given.
+        notify is called with the books moved before the transaction is
+        committed, so the emails it queues go out only if the change does.
+        Returns a list of (id, seller id, price) of the books moved
+        """
+        now = datetime.today()
+        if not self.contended:
+            # nobody else can change the books until this commits, so the
+            # books read here are exactly the ones the UPDATE moves
+            lock_books(ids)
+        books = Book.objects.filter(id__in=ids, status__in=self.allowed)
+        if restrict is not None: books = books.filter(restrict)
+        seen = list(books.values_list('id', 'seller', 'price', 'status'))
+        if not seen: return []
+        values = self.field_values(who, now)
+        if self.contended:
+            moved = self._apply_each(seen, values, restrict)
+        else:
+            moved = self._apply_all(seen, values)
+        insert_logs([(self.log, row[0], who.id, row[3], self.status)
+                     for row in moved], now)
+        count_status_changes([(row[3], self.status) for row in moved])
+        if self.status == 'S' and moved:
+            add_daily_sales([row[0] for row in moved])
+            sold = Book.objects.filter(id__in=[row[0] for row in moved])
+            update_price_stats(sold.values_list('metabook', flat=True), now)
+        moved = [row[:3] for row in moved]
+        if notify is not None and moved: notify(moved_books(moved))
+        return moved
+    apply = bump_version_once(BOOKS_VERSION)(apply)
+    apply = transaction.commit_on_success(apply)
+
+    def _apply_each(self, seen, values, restrict):
+        """
+        One UPDATE per book on the condition that it still has the status
+        it was seen with. Whoever's UPDATE changes the row got the book
+        """
+        moved = []
+        for id, seller, price, status in seen:
+            books = Book.objects.filter(id=id, status=status)
+            if restrict is not None: books = books.filter(restrict)
+            if books.update(**values):
+                moved.append((id, seller, price, status))
+        return moved
+
+    def _apply_all(self, seen, values):
+        """
+        A single UPDATE for every book. The books are locked, so every
+        one seen is still the way it was when it was read
+        """
+        Book.objects.filter(id__in=[row[0] for row in seen]).update(**values)
+        return seen
+
+TRANSITIONS = {
+    'Delete' : Transition('FMOPST', 'D', 'D'),
+    # can't do this for Deleted, Seller Paid, and Sold Books
+    'To Be Deleted' : Transition('FMOT', 'T', 'T'),
+    # Allow only if For Sale or On Hold
+    'Sold' : Transition('FO', 'S', 'S', sell_date=NOW),
+    # A Seller can be paid only after the book was sold
+    'Seller Paid' : Transition('S', 'P', 'P'),
+    # Must be For Sale, On Hold or To Be Deleted for it to go Missing
+    'Missing' : Transition('FOT', 'M', 'M'),
+    # students race each other for books at the start of term
+    'Place on Hold' : Transition('F', 'O', 'O', contended=True,
+                                 holder=WHO, hold_date=NOW),
+    # only for books the user is already holding
+    'Extend Hold' : Transition('O', 'O', 'X', contended=True, hold_date=NOW),
+    'Remove Holds' : Transition('O', 'F', 'R', holder=None, hold_date=None),
+}
+
+def apply(action, ids, who, restrict=None, notify=None):
+    """
+    Applies the transition called action, see Transition.apply
+    """
+    return TRANSITIONS[action].apply(ids, who, restrict, notify)
+
+def moved_books(moved):
+    """
+    The books in the result of a transition, ready to be listed or emailed
+    """
+    ids = [row[0] for row in moved]
+    return Book.objects.filter(id__in=ids).select_related('metabook', 'seller')
+
+def owners(moved):
+    """
+    The number of different sellers in the result of a transition
+    """
+    return len(set([row[1] for row in moved]))
+
+def undelete(ids, who):
+    """
+    Puts the deleted books in ids back to the status they had before they
+    were deleted, with one UPDATE per status they go back to. Books whose
+    previous status isn't known go back to For Sale.
+    Returns the number of books undeleted
+    """
+    # nobody else can undelete them until this commits, so every book
+    # found deleted here is one this call undeletes
+    lock_books(ids)
+    deleted = Book.objects.filter(id__in=ids, status='D')
+    deleted = list(deleted.values_list('id', flat=True))
+    previous = previous_statuses(deleted)
+    by_status = {}
+    for id in deleted:
+        by_status.setdefault(previous.get(id, 'F'), []).append(id)
+    undeleted = []
+    for status, status_ids in by_status.items():
+        Book.objects.filter(id__in=status_ids).update(status=status)
+        undeleted.extend([('U', id, who.id, 'D', status) for id in status_ids])
+    insert_logs(undeleted)
+    count_status_changes([(row[3], row[4]) for row in undeleted])
+    return len(undeleted)
+undelete = bump_version_once(BOOKS_VERSION)(undelete)
+undelete = transaction.commit_on_success(undelete)
@@ -45,18 +45,21 @@ def bad_unholds(request):
         t = loader.get_template('403.html')
         c = RC(request, {})
         return HttpResponseForbidden(t.render(c))
+    # A hold can only properly be removed from a book that is on hold.
+    # Logs from before statuses were logged have no from status until the
+    # backfill_log_statuses command has been run
+    bad = Log.objects.filter(action='R').exclude(from_status__in=('O', ''))
+    bad = list(bad.order_by('when'))
+    logs = Log.objects.filter(book__in=[log.book_id for log in bad])
+    logs = logs.select_related('book', 'who').order_by('when', 'id')
+    history = {}
+    for log in logs: history.setdefault(log.book_id, []).append(log)
     entries = []
-    for book in Book.objects.all():
-        logs = Log.objects.filter(book=book) 
-        for r_log in logs.filter(action='R'):
-            bad_actions = ['M', 'P', 'S', 'T', 'D']
-            bad_logs = logs.filter(action__in=bad_actions, when__lte=r_log.when)
-            if bad_logs.count() > 0:
-                # If a book has been marked as Missing, On Hold, Sold
-                # To Be Deleted of Deleted before having a hold removed
-                entry = []
-                for log in logs: entry.append((log, True if log == r_log else False))
-                entries.append(entry)
+    for r_log in bad:
+        entry = []
+        for log in history[r_log.book_id]:
+            entry.append((log, log.id == r_log.id))
+        entries.append(entry)
     var_dict = {
         'entries' : entries,
     }
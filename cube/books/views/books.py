@@ -2,21 +2,35 @@
 
 # django imports
 from cube.books.models import MetaBook, Course, Book, Log
-from cube.books.forms import NewBookForm, BookForm, FilterForm 
+from cube.books.forms import NewBookForm, BookForm, FilterForm, price_help
 from cube.books.views.tools import book_filter,\
                                   book_sort, get_number, tidy_error,\
-                                  house_cleaning
+                                  status_sort,\
+                                  cursor_keys, StatusKey, load_book_page,\
+                                  cached_book_filter, barcode_price_stats,\
+                                  books_etag
+from cube.books.models import load_courses, add_daily_sales,\
+                              remove_daily_sales, update_price_stats,\
+                              PriceStats
+from cube.books.pagination import CursorPaginator
+from cube.books import transitions
 from cube.twupass.tools import import_user
 from cube.books.email import send_missing_emails, send_sold_emails,\
                              send_tbd_emails
 from cube.books.http import HttpResponseNotAllowed
+from cube.books.search import suggest as search_suggest
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db import transaction
+from django.db.models import Q
 from django.http import HttpResponseRedirect, HttpResponse,\
                         HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import render_to_response as rtr
 from django.template import loader, RequestContext as RC
+from django.views.decorators.http import condition
+
+from django.utils import simplejson
 
 #python imports
 from datetime import datetime
@@ -26,7 +40,12 @@ from decimal import Decimal
 PER_PAGE = '30'
 PAGE_NUM = '1'
 
+# Columns which the book list can be cursor paginated by
+CURSOR_SORTS = ('metabook__title', 'metabook__author', 'price', 'id',
+                'status', 'list_date', 'metabook__course_list')
+
 @login_required()
+@condition(etag_func=books_etag)
 def book_list(request):
     """
     Shows a list of all the books listed.
@@ -36,40 +55,54 @@ def book_list(request):
         - GETTest
         - SearchBookTest
         - SortBookTest
+        - ConditionalGetTest
     """
-    house_cleaning()
+    sort_by = ''
     # Filter for the search box
     if request.method == 'GET':
         filter_form = FilterForm(request.GET)
         if filter_form.is_valid():
             cd = filter_form.cleaned_data
-            all_books = Book.objects.all()
-            books = book_filter(cd['filter'], cd['field'], all_books)
+            staff = request.user.is_staff
+            books = cached_book_filter(cd['filter'], cd['field'], staff)
         elif request.GET.has_key("sort_by") and request.GET.has_key("dir"):
-            books = book_sort(request.GET["sort_by"], request.GET["dir"])
+            sort_by = request.GET["sort_by"]
+            books = book_sort(sort_by, request.GET["dir"])
         else:
             books = Book.objects.all()
 
     # Filter according to permissions
     if not request.user.is_staff:
         # Non staff can only see books which are for sale.
-        books = filter(lambda x: x.status == 'F', books)
-    # Staff want to see the unsold books first so if we sort them ascending, that should do
+        books = books.filter(status='F')
+    # Staff want to see the unsold books first
     else:
-        # This alphabet is the order in which book statuses should be displayed
-        alphabet = "AFOPMTSD"
-        # Sort by the index value of the book status in the alphabet
-        books = sorted(books, key=lambda book: [alphabet.index(book.status)])
+        books = status_sort(books)
+
+    # Fetch the related rows shown on each line along with the books
+    books = books.select_related('metabook', 'seller', 'holder')
 
     # Pagination
     page_num = get_number(request.GET, 'page', PAGE_NUM)
     books_per_page = get_number(request.GET, 'per_page', PER_PAGE)
 
-    paginator = Paginator(books, books_per_page)
-    try:
-        page_of_books = paginator.page(page_num)
-    except (EmptyPage, InvalidPage):
-        page_of_books = paginator.page(paginator.num_pages)
+    # Cursor pagination skips the count and the OFFSET, so deep pages
+    # cost the same as the first one. It's used unless a page number
+    # is asked for or the list is sorted by a column it can't handle
+    keys = None
+    if request.GET.has_key('cursor') or not request.GET.has_key('page'):
+        keys = cursor_keys(sort_by, request.GET.get('dir', ''), CURSOR_SORTS)
+    if keys is not None:
+        if request.user.is_staff: keys = [StatusKey()] + keys
+        paginator = CursorPaginator(books, keys, books_per_page)
+        page_of_books = paginator.page(request.GET.get('cursor'))
+    else:
+        paginator = Paginator(books, books_per_page)
+        try:
+            page_of_books = paginator.page(page_num)
+        except (EmptyPage, InvalidPage):
+            page_of_books = paginator.page(paginator.num_pages)
+    load_book_page(page_of_books)
 
     # Template time
     if request.GET.get('dir', '') == 'asc': dir = 'desc'
@@ -80,7 +113,10 @@ def book_list(request):
         'page' : page_num,
         'field' : request.GET.get('field', 'any_field'),
         'filter_text' : request.GET.get('filter', ''),
-        'dir' : dir
+        'dir' : dir,
+        'cursor_mode' : keys is not None,
+        'sort_by' : sort_by,
+        'sort_dir' : request.GET.get('dir', ''),
     }
     return rtr('books/book_list.html', var_dict, context_instance=RC(request))
 
@@ -99,7 +135,6 @@ def update_book(request):
         t = loader.get_template('405.html')
         c = RC(request)
         return HttpResponseNotAllowed(t.render(c), ['POST'])
-    bunch = Book.objects.none()
     action = request.POST.get("Action", '')
 
     # We need at least 1 thing to edit, otherwise bad things can happen
@@ -112,98 +147,71 @@ def update_book(request):
         c = RC(request, var_dict)
         return HttpResponseBadRequest(t.render(c))
     # For each form key of idToEdit add its value to our list of items to process
-    for value in request.POST.getlist('idToEdit'):
-        bunch = bunch | Book.objects.filter(pk=int(value))
+    ids = [int(value) for value in request.POST.getlist('idToEdit')]
+    bunch = Book.objects.filter(id__in=ids)
         
     if action == "Delete":
-        bunch = bunch.exclude(status='D')
-        for book in bunch:
-            Log(action='D', book=book, who=request.user).save()
-        var_dict = { 'num_deleted': bunch.count() }
-        bunch.update(status='D')
+        moved = transitions.apply('Delete', ids, request.user)
+        var_dict = { 'num_deleted': len(moved) }
         template = 'books/update_book/deleted.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action[:1] == "To Be Deleted"[:1]:
         # apparently some browsers have issues passing spaces
-        # can't do this for Deleted, Seller Paid, and Sold Books
-        bunch = bunch.exclude(status__in='DPS')
-        send_tbd_emails(bunch)
-        for book in bunch:
-            Log(action='T', book=book, who=request.user).save()
+        moved = transitions.apply('To Be Deleted', ids, request.user,
+                                  notify=send_tbd_emails)
         var_dict = {
-            'num_doomed' : bunch.count(),
-            'num_owners' : len(set(map(lambda x: x.seller, bunch))),
+            'num_doomed' : len(moved),
+            'num_owners' : transitions.owners(moved),
         }
-        bunch.update(status='T')
         template = 'books/update_book/to_be_deleted.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action == "Sold":
-        # Allow only if For Sale or On Hold
-        bunch = bunch.filter(status__in='FO')
-        for book in bunch:
-            Log(action='S', book=book, who=request.user).save()
-        send_sold_emails(list(bunch))
+        moved = transitions.apply('Sold', ids, request.user,
+                                  notify=send_sold_emails)
         var_dict = {
-            'sold' : bunch.count(),
-            'num_owners' : len(set(map(lambda x: x.seller, bunch))),
+            'sold' : len(moved),
+            'num_owners' : transitions.owners(moved),
         }
-        bunch.update(status='S', sell_date=datetime.today())
         template = 'books/update_book/sold.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action[:5] == "Seller Paid"[:5]:
         # apparently some browsers have issues passing spaces
         # only staff can do this
-        if not request.user.is_staff: bunch = Book.objects.none()
-        # A Seller can be paid only after the book was sold
-        else: bunch = bunch.filter(status='S')
-
-        for book in bunch:
-            Log(action='P', book=book, who=request.user).save()
-        var_dict = {'paid' : bunch.count()}
-        bunch.update(status='P')
+        if not request.user.is_staff: moved = []
+        else: moved = transitions.apply('Seller Paid', ids, request.user)
+        var_dict = {'paid' : len(moved)}
         template = 'books/update_book/seller_paid.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action == "Missing":
-        # Must be For Sale, On Hold or To Be Deleted for it to go Missing
-        bunch = bunch.filter(status__in='FOT')
-        for book in bunch:
-            Log(action='M', book=book, who=request.user).save()
-        send_missing_emails(bunch)
+        moved = transitions.apply('Missing', ids, request.user,
+                                  notify=send_missing_emails)
         var_dict = {
-            'num_owners' : len(set(map(lambda x: x.seller, bunch))),
-            'num_missing' : bunch.count(),
+            'num_owners' : transitions.owners(moved),
+            'num_missing' : len(moved),
         }
-        bunch.update(status='M')
         template = 'books/update_book/missing.html'
         return rtr(template, var_dict,  context_instance=RC(request))
     elif action[:4] == "Place on Hold"[:4]:
         # apparently some browsers have issues passing spaces
-        extended = bunch.filter(status='O', holder=request.user)
-        new_hold = bunch.filter(status='F')
-        failed = bunch.exclude(status__in='OF', holder=request.user)
-        for book in new_hold:
-            Log(action='O', book=book, who=request.user).save()
-        for book in extended:
-            Log(action='X', book=book, who=request.user).save()
-        held = extended | new_hold
+        extended = transitions.apply('Extend Hold', ids, request.user,
+                                     Q(holder=request.user))
+        new_hold = transitions.apply('Place on Hold', ids, request.user)
+        held = extended + new_hold
+        held_ids = [row[0] for row in held]
         var_dict = {
-            'failed' : failed,
-            'extended' : extended,
-            'new_hold' : new_hold,
-            'num_held' : held.count(),
-            'total_price' : sum(map(lambda x: x.price, held)),
+            'failed' : bunch.exclude(id__in=held_ids).select_related('metabook'),
+            'extended' : transitions.moved_books(extended),
+            'new_hold' : transitions.moved_books(new_hold),
+            'num_held' : len(held),
+            'total_price' : sum([row[2] for row in held]),
         }
-        extended.update(hold_date = datetime.today())
-        new_hold.update(status='O', hold_date=datetime.today(), holder=request.user)
         template = 'books/update_book/place_hold.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action[:5] == "Remove Holds"[:5]:
-        bunch = bunch.filter(status='O')
-        if not request.user.is_staff: bunch = bunch.filter(holder=request.user)
-        for book in bunch:
-            Log(action='R', book=book, who=request.user).save()
-        var_dict = {'removed' : bunch.count()}
-        bunch.update(status='F', hold_date=None, holder=None)
+        if request.user.is_staff: restrict = None
+        else: restrict = Q(holder=request.user)
+        moved = transitions.apply('Remove Holds', ids, request.user, restrict)
+        var_dict = {'removed' : len(moved)}
         template = 'books/update_book/remove_holds.html'
         return rtr(template, var_dict, context_instance=RC(request))
     elif action == "Edit":
@@ -215,7 +223,11 @@ def update_book(request):
             'price' : item.price,
             'barcode' : item.metabook.barcode,
         }
-        form = BookForm(initial=initial)
+        try:
+            stats = item.metabook.price_stats
+        except PriceStats.DoesNotExist:
+            stats = None
+        form = BookForm(initial=initial, price_stats=stats)
         logs = Log.objects.filter(book=item)
         var_dict = {
             'form' : form,
@@ -227,18 +239,10 @@ def update_book(request):
         return rtr(template, var_dict, context_instance=RC(request))
     elif action == "Undelete":
         # only staff can do this
-        if not request.user.is_staff: 
-            bunch = Book.objects.none()
-
-        # Filter out any books that aren't deleted
-        bunch = bunch.filter(status='D') 
-
-        # For each book revert to what its previous status was before being deleted
-        for book in bunch:
-            book.status = book.previous_status()
-            book.save()
-            Log(action='U', book=book, who=request.user).save()
-        var_dict = {'num_undeleted' : bunch.count()}
+        if not request.user.is_staff: num_undeleted = 0
+        # revert each deleted book to what its status was before being deleted
+        else: num_undeleted = transitions.undelete(ids, request.user)
+        var_dict = {'num_undeleted' : num_undeleted}
         template = 'books/update_book/undeleted.html'
         return rtr(template, var_dict, context_instance=RC(request))
         
@@ -248,6 +252,7 @@ def update_book(request):
         return rtr(template, var_dict, context_instance=RC(request))
 
 @login_required()
+@transaction.commit_on_success
 def update_book_edit(request):
     """
     Applies changes to a book made on the edit page
@@ -276,6 +281,8 @@ def update_book_edit(request):
         except Book.DoesNotExist:
             message = 'Book with ref# "%s" does not exist' % id_to_edit
             return tidy_error(request, message)
+        # a sold copy moved to another title comes out of the old one's stats
+        old_metabook_id = book.metabook_id
         try:
             barcode = form.cleaned_data['barcode']
             book.metabook = MetaBook.objects.get(barcode=barcode)
@@ -302,8 +309,13 @@ def update_book_edit(request):
                 return tidy_error(request, message)
             book.seller = user
         book.price = form.cleaned_data['price']
+        if book.sell_date: remove_daily_sales([book.id])
         book.save()
-        Log(who=request.user, action='E', book=book).save()
+        if book.sell_date:
+            add_daily_sales([book.id])
+            update_price_stats([old_metabook_id, book.metabook_id])
+        Log(who=request.user, action='E', book=book,
+            from_status=book.status, to_status=book.status).save()
         var_dict = {'book' : book}
         template = 'books/update_book/edited.html'
         return rtr(template, var_dict, context_instance=RC(request))
@@ -321,6 +333,7 @@ def update_book_edit(request):
         return rtr(template, var_dict, context_instance=RC(request))
 
 @login_required()
+@transaction.commit_on_success
 def attach_book(request):
     """
     Tests:
@@ -358,11 +371,16 @@ def attach_book(request):
     metabook.edition = form.cleaned_data['edition']
     metabook.save()
     metabook.courses.add(course)
-    metabook.save()
+    metabook.update_course_list()
 
     book = Book.objects.get(pk=form.cleaned_data['book_id'])
+    old_metabook_id = book.metabook_id
+    if book.sell_date: remove_daily_sales([book.id])
     book.metabook = metabook
     book.save()
+    if book.sell_date:
+        add_daily_sales([book.id])
+        update_price_stats([old_metabook_id, metabook.id])
     var_dict = {'book' : book}
     template = 'books/attached.html'
     return rtr(template, var_dict, context_instance=RC(request))
@@ -403,6 +421,11 @@ def my_books(request):
     elif request.GET.has_key("sort_with") and request.GET.has_key("dir"):
         selling = book_sort(request.GET["sort_with"], request.GET["dir"])
         selling = selling.filter(seller = request.user)
+
+    # Evaluate the lists once with their related rows and course codes
+    selling = list(selling.select_related('metabook', 'holder'))
+    holding = list(holding.select_related('metabook', 'seller'))
+    load_courses([book.metabook for book in selling + holding])
    
     var_dict = {
          'sellP' : selling,
@@ -481,7 +504,7 @@ def add_book(request):
                     return tidy_error(request, message)
             book = Book(price=price, status="F", metabook=metabook, seller=seller)
             book.save()
-            Log(book=book, who=request.user, action='A').save()
+            Log(book=book, who=request.user, action='A', to_status='F').save()
             var_dict = {
                 'title' : metabook.title,
                 'book_id' : book.id
@@ -489,6 +512,8 @@ def add_book(request):
             template = 'books/update_book/added.html'
             return rtr(template, var_dict, context_instance=RC(request))
         # the form isn't valid. send the user back.
+        stats = barcode_price_stats(request.POST.get('barcode', ''))
+        form = BookForm(request.POST, price_stats=stats)
         var_dict = {'form' : form}
         template = 'books/add_book.html'
         return rtr(template, var_dict, context_instance=RC(request))
@@ -535,7 +560,7 @@ def add_new_book(request):
             goc = Course.objects.get_or_create
             course, created = goc(department=dept, number=course_num)
             metabook.courses.add(course)
-            metabook.save()
+            metabook.update_course_list()
             try:
                 seller = User.objects.get(pk=sid)
             except User.DoesNotExist:
@@ -546,7 +571,7 @@ def add_new_book(request):
             book = Book(seller=seller, price=Decimal(price), metabook=metabook)
             book.status = 'F'
             book.save()
-            Log(book=book, who=request.user, action='A').save()
+            Log(book=book, who=request.user, action='A', to_status='F').save()
 
             var_dict = {
                 'title' : metabook.title,
@@ -581,10 +606,51 @@ def remove_holds_by_user(request):
         if "holder_id" == key:
             holder = User.objects.get(pk=int(value))
             break
-    books = Book.objects.filter(holder=holder, status='O')
-    for book in books:
-        Log(action='R', book=book, who=request.user).save()
-    var_dict = {'removed' : books.count()}
-    books.update(status='F', hold_date=None, holder=None)
+    held = Book.objects.filter(holder=holder, status='O')
+    ids = list(held.values_list('id', flat=True))
+    moved = transitions.apply('Remove Holds', ids, request.user,
+                              Q(holder=holder))
+    var_dict = {'removed' : len(moved)}
     template = 'books/update_book/remove_holds.html'
     return rtr(template, var_dict, context_instance=RC(request))
+
+@login_required()
+def suggest(request):
+    """
+    Returns a JSON list of titles, authors, barcodes and course codes
+    starting with what has been typed into the search box so far
+
+    Tests: SuggestTest
+    """
+    prefix = request.GET.get('q', '')
+    limit = min(get_number(request.GET, 'limit', '10'), 50)
+    suggestions = search_suggest(prefix, limit)
+    return HttpResponse(simplejson.dumps(suggestions),
+                        mimetype="application/json")
+
+@login_required()
+def price(request):
+    """
+    Returns the price stats of the book with the barcode just scanned
+    as JSON, or an empty object if no copies of it have sold
+
+    Tests: PriceStatsTest
+    """
+    # User must be staff or admin to get to this page
+    if not request.user.is_staff:
+        t = loader.get_template('403.html')
+        c = RC(request)
+        return HttpResponseForbidden(t.render(c))
+    stats = barcode_price_stats(request.GET.get('barcode', ''))
+    data = {}
+    if stats is not None:
+        data = {
+            'suggested' : str(stats.suggested),
+            'sold' : stats.sold,
+            'lowest' : str(stats.lowest),
+            'median' : str(stats.median),
+            'highest' : str(stats.highest),
+            'sales_per_week' : stats.sales_per_week(),
+            'help' : price_help(stats),
+        }
+    return HttpResponse(simplejson.dumps(data), mimetype="application/json")
@@ -1,8 +1,9 @@
 # Copyright (C) 2010  Trinity Western University
 
-from cube.books.models import MetaBook, Course
+from cube.books.models import MetaBook, Course, load_courses
 from cube.books.forms import MetaBookForm, CourseForm
-from cube.books.views.tools import metabook_sort, get_number
+from cube.books.views.tools import metabook_sort, get_number, cursor_keys
+from cube.books.pagination import CursorPaginator
 from cube.books.http import HttpResponseNotAllowed
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
@@ -14,6 +15,9 @@ from django.template import loader, RequestContext as RC
 PER_PAGE = '30'
 PAGE_NUM = '1'
 
+# Columns which the metabook list can be cursor paginated by
+CURSOR_SORTS = ('title', 'author', 'barcode', 'edition', 'id', 'course_list')
+
 @login_required()
 def metabook_list(request):
     """
@@ -28,19 +32,32 @@ def metabook_list(request):
         t = loader.get_template('403.html')
         c = RC(request)
         return HttpResponseForbidden(t.render(c))
+    sort_by = ''
     if request.GET.has_key("sort_by") and request.GET.has_key("dir"):
-        metabooks = metabook_sort(request.GET["sort_by"], request.GET["dir"])
+        sort_by = request.GET["sort_by"]
+        metabooks = metabook_sort(sort_by, request.GET["dir"])
     else: metabooks = MetaBook.objects.all()
 
     # Pagination
     page_num = get_number(request.GET, 'page', PAGE_NUM)
     metabooks_per_page = get_number(request.GET, 'per_page', PER_PAGE)
 
-    paginator = Paginator(metabooks, metabooks_per_page)
-    try:
-        page_of_metabooks = paginator.page(page_num)
-    except (EmptyPage, InvalidPage):
-        page_of_metabooks = paginator.page(paginator.num_pages)
+    # Cursor pagination is used unless a page number is asked for or the
+    # list is sorted by a column it can't handle
+    keys = None
+    if request.GET.has_key('cursor') or not request.GET.has_key('page'):
+        keys = cursor_keys(sort_by, request.GET.get('dir', ''), CURSOR_SORTS)
+    if keys is not None:
+        paginator = CursorPaginator(metabooks, keys, metabooks_per_page)
+        page_of_metabooks = paginator.page(request.GET.get('cursor'))
+    else:
+        paginator = Paginator(metabooks, metabooks_per_page)
+        try:
+            page_of_metabooks = paginator.page(page_num)
+        except (EmptyPage, InvalidPage):
+            page_of_metabooks = paginator.page(paginator.num_pages)
+    page_of_metabooks.object_list = list(page_of_metabooks.object_list)
+    load_courses(page_of_metabooks.object_list)
 
     # Template time
     if request.GET.get('dir', '') == 'asc': dir = 'desc'
@@ -49,7 +66,10 @@ def metabook_list(request):
         'metabooks' : page_of_metabooks,
         'per_page' : metabooks_per_page,
         'page' : page_num,
-        'dir' : 'desc' if request.GET.get('dir', '') == 'asc' else 'asc'
+        'dir' : 'desc' if request.GET.get('dir', '') == 'asc' else 'asc',
+        'cursor_mode' : keys is not None,
+        'sort_by' : sort_by,
+        'sort_dir' : request.GET.get('dir', ''),
     }
 
     template = 'books/list_metabooks.html'
@@ -116,6 +136,7 @@ def update(request):
             course = tpl[0]
             metabook = metabook_form.save()
             metabook.courses.add(course)
+            metabook.update_course_list()
 
             var_dict={'metabook': metabook}
             template = 'books/update_metabook/saved.html'
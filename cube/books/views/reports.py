@@ -1,24 +1,36 @@
 # Copyright (C) 2010  Trinity Western University
 
-from cube.books.models import Book, MetaBook, Log
+from cube.books.models import Book, MetaBook, Log, status_counts, DailySales,\
+                              PriceStats
 from cube.books.forms import DateRangeForm
 from cube.twupass.tools import import_user
-from cube.books.views.tools import tidy_error
+from cube.books.views.tools import tidy_error, get_number, books_etag
 from cube.books.http import HttpResponseNotAllowed
+from cube.books.export import FORMATS, export_response
+from cube.books.pagination import CursorPaginator, iterate, Key
 
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition
 from django.shortcuts import render_to_response as rtr
 from django.template import loader, RequestContext as RC
 from django.http import HttpResponseForbidden
 from django.contrib.auth.models import User
-from django.db.models import Sum
+from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db.models import Count, Sum
+from datetime import timedelta
+
+# pagination defaults
+PER_PAGE = '50'
+PAGE_NUM = '1'
 
 @login_required()
+@condition(etag_func=books_etag)
 def menu(request):
     """
     Tests:
         - GETTest
         - SecurityTest
+        - ConditionalGetTest
     """
     # User must be staff or admin to get to this page
     if not request.user.is_staff:
@@ -31,6 +43,7 @@ def menu(request):
     return rtr('books/reports/menu.html', var_dict, context_instance=RC(request))
 
 @login_required()
+@condition(etag_func=books_etag)
 def per_status(request):
     """
     Shows the number of books per status
@@ -38,20 +51,22 @@ def per_status(request):
     Tests:
         - GETTest
         - SecurityTest
+        - ConditionalGetTest
     """
     # User must be staff or admin to get to this page
     if not request.user.is_staff:
         t = loader.get_template('403.html')
         c = RC(request, {})
         return HttpResponseForbidden(t.render(c))
+    counts = status_counts()
     var_dict = {
-        "for_sale" : Book.objects.filter(status='F').count(),
-        "missing" : Book.objects.filter(status='M').count(),
-        "on_hold" : Book.objects.filter(status='O').count(),
-        "seller_paid" : Book.objects.filter(status='P').count(),
-        "sold" : Book.objects.filter(status='S').count(),
-        "to_be_deleted" : Book.objects.filter(status='T').count(),
-        "deleted" : Book.objects.filter(status='D').count(),
+        "for_sale" : counts['F'],
+        "missing" : counts['M'],
+        "on_hold" : counts['O'],
+        "seller_paid" : counts['P'],
+        "sold" : counts['S'],
+        "to_be_deleted" : counts['T'],
+        "deleted" : counts['D'],
     }
     return rtr('books/reports/per_status.html', var_dict, context_instance=RC(request))
 
@@ -82,16 +97,29 @@ def books_sold_within_date(request):
     
     to_date = date_range_form.cleaned_data['to_date']
     from_date = date_range_form.cleaned_data['from_date']
-    book_sale_logs = Log.objects.filter(action='S', when__gte=from_date).exclude(when__gt=to_date)
+    # Uses the index on sell_date for both the range and the ordering
+    books_sold = Book.objects.filter(sell_date__gte=from_date,
+                                     sell_date__lt=to_date + timedelta(1))
 
-    # Find all the books for the related Logs
-    books_sold = Book.objects.filter(id__in=book_sale_logs.values('book_id'))
-    
-    # Sum up the price of all the books retrieved previously
-    total_money = books_sold.aggregate(total=Sum('price'))['total']
+    format = request.POST.get('format', '')
+    if FORMATS.has_key(format):
+        header = ('Ref', 'Title', 'Barcode', 'Seller', 'Buyer', 'Price',
+                  'Date Sold')
+        books = books_sold.select_related('metabook', 'seller', 'holder')
+        rows = ((book.id, book.metabook.title, book.metabook.barcode,
+                 book.seller.get_full_name(),
+                 book.holder and book.holder.get_full_name(),
+                 book.price, book.sell_date)
+                for book in iterate(books, [Key('sell_date')]))
+        return export_response(header, rows, format, 'books_sold')
+
+    # The daily rollup already has the total of each day
+    days = DailySales.objects.filter(day__gte=from_date, day__lte=to_date)
+    total_money = days.aggregate(total=Sum('revenue'))['total']
 
     var_dict = {
-        'book_sale_logs' : book_sale_logs.order_by('book__sell_date'),
+        'books_sold' : books_sold.select_related('metabook', 'seller', 'holder')\
+                                 .order_by('sell_date', 'id'),
         'total_money' : total_money,
         'from_date' : from_date,
         'to_date' : to_date,
@@ -121,11 +149,45 @@ def user(request, user_id):
     if user_obj == None:
         message = "Invalid Student ID: %s" % user_id
         return tidy_error(request, message)
-    logs_of_books_for_sale = Log.objects.filter(book__seller=user_obj).filter(action='A')
+    logs = Log.objects.filter(who=user_obj)\
+                      .select_related('book', 'book__metabook')
+    logs_of_books_for_sale = Log.objects.filter(book__seller=user_obj)\
+                                        .filter(action='A')\
+                                        .select_related('book', 'book__metabook',
+                                                        'who')
+    format = request.GET.get('format', '')
+    if FORMATS.has_key(format):
+        if request.GET.get('list', '') == 'listed':
+            header = ('Date Listed', 'Ref', 'Title', 'Listed By', 'Status')
+            rows = ((log.book.list_date, log.book.id, log.book.metabook.title,
+                     log.who.get_full_name(), log.book.get_status_display())
+                    for log in iterate(logs_of_books_for_sale, [Key('when')]))
+            filename = 'user_%s_listed' % user_obj.id
+        else:
+            header = ('Date', 'Action', 'Ref', 'Title')
+            rows = ((log.when, log.get_action_display(), log.book.id,
+                     log.book.metabook.title)
+                    for log in iterate(logs, [Key('when')]))
+            filename = 'user_%s_actions' % user_obj.id
+        return export_response(header, rows, format, filename)
+
+    # Both lists are paged by (when, id) so old pages cost as little as new
+    per_page = get_number(request.GET, 'per_page', PER_PAGE)
+    cursor = request.GET.get('cursor', '')
+    listed = request.GET.get('listed', '')
+    logs_page = CursorPaginator(logs, [Key('when')], per_page).page(cursor)
+    listed_page = CursorPaginator(logs_of_books_for_sale, [Key('when')], per_page)\
+                  .page(listed)
     var_dict = {
     'user_obj' : user_obj,
-    'logs' : Log.objects.filter(who=user_obj).order_by('when'),
-    'logs_of_books_for_sale' : logs_of_books_for_sale,
+    'logs' : logs_page.object_list,
+    'logs_page' : logs_page,
+    'logs_of_books_for_sale' : listed_page.object_list,
+    'listed_page' : listed_page,
+    'per_page' : per_page,
+    # each list's pager keeps the other list on its page
+    'cursor' : cursor,
+    'listed' : listed,
     }
     return rtr('books/reports/user.html', var_dict, context_instance=RC(request))
 
@@ -177,18 +239,25 @@ def metabook(request, metabook_id):
     except MetaBook.DoesNotExist:
         message = "Invalid MetaBook Ref #: %s" % metabook_id
         return tidy_error(request, message)
+    try:
+        price_stats = metabook.price_stats
+    except PriceStats.DoesNotExist:
+        price_stats = None
     var_dict = {
     'metabook' : metabook,
     'books' : Book.objects.filter(metabook=metabook).order_by('list_date'),
+    'price_stats' : price_stats,
     }
     return rtr('books/reports/metabook.html', var_dict, context_instance=RC(request))
 
 @login_required()
+@condition(etag_func=books_etag)
 def holds_by_user(request):
     """
     Tests:
         - GETTest
         - SecurityTest
+        - ConditionalGetTest
     """
     if request.method == "POST":
         t = loader.get_template('405.html')
@@ -199,15 +268,77 @@ def holds_by_user(request):
         t = loader.get_template('403.html')
         c = RC(request, {})
         return HttpResponseForbidden(t.render(c))
-    books_on_hold = Book.objects.filter(status='O')
-    user_dict = {}
-    for book in books_on_hold:
-        if not user_dict.has_key(book.holder):
-            user_dict[book.holder] = Book.objects.filter(status='O', holder=book.holder).count()
-    user_list_by_user = user_dict.items()
-    user_list_by_count = []
-    for item in user_list_by_user:
-        user_list_by_count.append((item[1], item[0]))
-    user_list_by_count.sort(reverse=True)
-    var_dict = {'user_list': user_list_by_count}
+    # Filtering before annotating means only the holds are counted
+    holders = User.objects.filter(holding__status='O')\
+                          .annotate(hold_count=Count('holding'))\
+                          .order_by('-hold_count', 'last_name', 'first_name', 'id')
+    page_num = get_number(request.GET, 'page', PAGE_NUM)
+    holders_per_page = get_number(request.GET, 'per_page', PER_PAGE)
+    paginator = Paginator(holders, holders_per_page)
+    try:
+        page_of_holders = paginator.page(page_num)
+    except (EmptyPage, InvalidPage):
+        page_of_holders = paginator.page(paginator.num_pages)
+    user_list_by_count = [(holder.hold_count, holder)
+                          for holder in page_of_holders.object_list]
+    var_dict = {
+        'user_list': user_list_by_count,
+        'holders' : page_of_holders,
+        'per_page' : holders_per_page,
+    }
     return rtr('books/reports/holds_by_user.html', var_dict, context_instance=RC(request))
+
+@login_required()
+def sales_trend(request):
+    """
+    Shows the books sold and money taken in per day or per week and per
+    department over a date range, read from the daily sales rollup
+
+    Tests:
+        - SalesRollupTest
+    """
+    if not request.method == "POST":
+        t = loader.get_template('405.html')
+        c = RC(request)
+        return HttpResponseNotAllowed(t.render(c), ['POST'])
+    # User must be staff or admin to get to this page
+    if not request.user.is_staff:
+        t = loader.get_template('403.html')
+        c = RC(request, {})
+        return HttpResponseForbidden(t.render(c))
+    date_range_form = DateRangeForm(request.POST)
+    if not date_range_form.is_valid():
+        var_dict = {
+            'date_range_form' : date_range_form,
+        }
+        return rtr('books/reports/menu.html', var_dict, context_instance=RC(request))
+    to_date = date_range_form.cleaned_data['to_date']
+    from_date = date_range_form.cleaned_data['from_date']
+    weekly = request.POST.get('period', '') == 'week'
+    days = DailySales.objects.filter(day__gte=from_date, day__lte=to_date)
+
+    per_day = days.values('day').annotate(num_books=Sum('books'),
+                                          money=Sum('revenue')).order_by('day')
+    periods = []
+    for row in per_day:
+        start = row['day']
+        # weeks start on Monday
+        if weekly: start = start - timedelta(start.weekday())
+        if periods and periods[-1]['start'] == start:
+            periods[-1]['num_books'] += row['num_books']
+            periods[-1]['money'] += row['money']
+        else:
+            periods.append({'start' : start, 'num_books' : row['num_books'],
+                            'money' : row['money']})
+
+    per_department = days.values('department')\
+                         .annotate(num_books=Sum('books'), money=Sum('revenue'))\
+                         .order_by('-money')
+    var_dict = {
+        'periods' : periods,
+        'weekly' : weekly,
+        'departments' : per_department,
+        'from_date' : from_date,
+        'to_date' : to_date,
+    }
+    return rtr('books/reports/sales_trend.html', var_dict, context_instance=RC(request))
@@ -5,6 +5,7 @@ from django.http import HttpResponseForbidden
 from cube.books.views.tools import get_number, tidy_error
 from cube.twupass.backend import TWUPassBackend
 from cube.books.http import HttpResponseNotAllowed
+from cube.books.pagination import CursorPaginator, Key
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response as rtr
@@ -29,11 +30,18 @@ def staff_list(request):
     users = User.objects.all().order_by('last_name')
     page_num = get_number(request.GET, 'page', PAGE_NUM)
     users_per_page = get_number(request.GET, 'per_page', PER_PAGE)
-    paginator = Paginator(users, users_per_page)
-    try:
-        page_of_users = paginator.page(page_num)
-    except (EmptyPage, InvalidPage):
-        page_of_users = paginator.page(paginator.num_pages)
+    # Cursor pagination is used unless a page number is asked for
+    cursor_mode = request.GET.has_key('cursor') or \
+                  not request.GET.has_key('page')
+    if cursor_mode:
+        paginator = CursorPaginator(users, [Key('last_name')], users_per_page)
+        page_of_users = paginator.page(request.GET.get('cursor'))
+    else:
+        paginator = Paginator(users, users_per_page)
+        try:
+            page_of_users = paginator.page(page_num)
+        except (EmptyPage, InvalidPage):
+            page_of_users = paginator.page(paginator.num_pages)
     if request.GET.get('dir', '') == 'asc': dir = 'desc'
     else: dir = 'asc'
     var_dict = {
@@ -43,6 +51,7 @@ def staff_list(request):
         'field' : request.GET.get('field', 'any_field'),
         'filter_text' : request.GET.get('filter', ''),
         'dir' : dir, 
+        'cursor_mode' : cursor_mode,
     }
     template = 'books/staff.html'
     return rtr(template, var_dict,  context_instance=RC(request))
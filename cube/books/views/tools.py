@@ -1,36 +1,122 @@
 # Copyright (C) 2010  Trinity Western University
 
-from cube.books.models import Book, MetaBook
+from cube.books.models import Book, MetaBook, load_courses, get_version,\
+                               BOOKS_VERSION, insert_logs, count_status_changes,\
+                               refresh_price_stats, PriceStats, lock_books,\
+                               bump_version_once
 from cube.books.email import send_tbd_emails
+from cube.books import search
+from cube.books.pagination import Key
+from cube.books.isbn import to_isbn13, canonical_barcode, InvalidISBN
+from django.db import connection, transaction
+from django.db.models import Q
 from django.db.models.query import QuerySet
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
-def expire_holds():
+def expire_holds(batch_size=500):
     """
-    Expires holds on books after 24 hours
+    Expires holds on books after 24 hours and logs each one as a
+    Removed Hold. Works through the due holds oldest first in batches
+    using the (status, hold_date) index, so each run only touches the
+    holds that came due since the last one
+    Returns the number of holds expired
     """
     yester = datetime.today() - timedelta(1)
-    expired_books = Book.objects.filter(status='O', hold_date__lte=yester)
-    expired_books.update(status='F', holder=None, hold_date=None)
+    expired = 0
+    while True:
+        due = Book.objects.filter(status='O', hold_date__lte=yester)\
+                          .order_by('hold_date')
+        batch = list(due.values_list('id', 'holder')[:batch_size])
+        if not batch: break
+        expired += _expire_batch(batch, yester)
+        if len(batch) < batch_size: break
+    return expired
 
-def warn_annual_sellers():
+def _expire_batch(batch, yester):
+    """
+    batch is a list of (book id, holder id) for holds which have run out
+    """
+    ids = [id for id, holder in batch]
+    # nobody else can change the books until this commits, so the holds
+    # still due here are exactly the ones the UPDATE expires, and holds
+    # extended or removed since we looked are left alone
+    lock_books(ids)
+    due = Book.objects.filter(id__in=ids, status='O', hold_date__lte=yester)
+    expired = list(due.values_list('id', 'holder'))
+    Book.objects.filter(id__in=[id for id, holder in expired])\
+                .update(status='F', holder=None, hold_date=None)
+    # The hold was the holder's, so the log goes down as theirs
+    insert_logs([('R', id, holder, 'O', 'F') for id, holder in expired])
+    count_status_changes([('O', 'F')] * len(expired))
+    return len(expired)
+_expire_batch = bump_version_once(BOOKS_VERSION)(_expire_batch)
+_expire_batch = transaction.commit_on_success(_expire_batch)
+
+def warn_annual_sellers(batch_size=500):
     """
     If a book is a year old, mark it as to be deleted and send them an email
     """
     last_year = datetime.today() - timedelta(365)
     old_books = Book.objects.filter(status='F', list_date__lte=last_year)
-    if old_books.count():
-        send_tbd_emails(old_books)
-        old_books.update(status='T')
+    while True:
+        ids = list(old_books.values_list('id', flat=True)[:batch_size])
+        if not ids: break
+        _warn_sellers(ids)
+        if len(ids) < batch_size: break
+
+def _warn_sellers(ids):
+    """
+    The emails are queued in the same transaction as the status change
+    """
+    lock_books(ids)
+    warned = Book.objects.filter(id__in=ids, status='F')
+    warned = list(warned.values_list('id', 'seller'))
+    warned_ids = [id for id, seller in warned]
+    Book.objects.filter(id__in=warned_ids).update(status='T')
+    # Nobody asked for it, so like an expired hold it goes down as the seller's
+    insert_logs([('T', id, seller, 'F', 'T') for id, seller in warned])
+    count_status_changes([('F', 'T')] * len(warned))
+    send_tbd_emails(Book.objects.filter(id__in=warned_ids)\
+                                .select_related('metabook', 'seller'))
+_warn_sellers = bump_version_once(BOOKS_VERSION)(_warn_sellers)
+_warn_sellers = transaction.commit_on_success(_warn_sellers)
 
 def house_cleaning():
     """
     calls methods which need to be done frequently
+    Run by the house_cleaning management command, not by the views
     """
     expire_holds()
     warn_annual_sellers()
+    refresh_price_stats()
+
+def barcode_price_stats(barcode):
+    """
+    The PriceStats of the book with barcode, or None if copies of it
+    have never sold. A single query
+    """
+    try:
+        barcode = canonical_barcode(barcode)
+    except InvalidISBN:
+        # could be one stored before ISBNs were checked
+        pass
+    stats = PriceStats.objects.filter(metabook__barcode=barcode)
+    for found in stats[:1]: return found
+    return None
+
+def books_etag(request, *args, **kwargs):
+    """
+    ETag for the pages built from the books, for use with the condition
+    decorator. It changes whenever a Book, MetaBook or Log is written,
+    for each user and role, and at midnight when naturalday dates and
+    default date ranges move on. Costs a single query
+    """
+    user = request.user
+    return "%d-%d-%d-%d-%s" % (get_version(BOOKS_VERSION), user.id,
+                               user.is_staff, user.is_superuser,
+                               date.today().isoformat())
 
 def tidy_error(request, error_message):
     """
@@ -51,10 +137,21 @@ def get_number(list, key, default):
         number = int(default)
     return number
 
-def book_filter(filter, field, books):
+def load_book_page(page):
+    """
+    Evaluates a page of books once and loads the course codes of every
+    book on it with a single query
+    """
+    page.object_list = list(page.object_list)
+    load_courses([book.metabook for book in page.object_list])
+    return page
+
+def book_filter(filter, field, books, indexed=True):
     """
     Returns a filtered list of Book objects only if the field is valid
     otherwise it returns all of the book objects
+    Title, author and barcode searches go through the search index
+    unless indexed is False or the filter is too short for the index
     """
     def status(filter):
         for choice in Book.STATUS_CHOICES:
@@ -79,14 +176,30 @@ def book_filter(filter, field, books):
         except ValueError:
             return Book.objects.none()
 
+    def indexed_field(filter, field):
+        if indexed:
+            found = search.metabooks(filter, (field,))
+            if found is not None:
+                return books.filter(metabook__in=found)
+        return books.filter(**{'metabook__%s__icontains' % field : filter})
+
     def title(filter):
-        return books.filter(metabook__title__icontains=filter)
+        return indexed_field(filter, 'title')
 
     def author(filter):
-        return books.filter(metabook__author__icontains=filter)
+        return indexed_field(filter, 'author')
+
+    def isbn(filter):
+        try:
+            return to_isbn13(filter)
+        except InvalidISBN:
+            return None
 
     def barcode(filter):
-        return books.filter(metabook__barcode__icontains=filter)
+        # A whole ISBN in either form is an exact match on the unique index
+        if isbn(filter):
+            return books.filter(metabook__barcode=isbn(filter))
+        return indexed_field(filter, 'barcode')
 
     def user(filter):
         try:
@@ -94,7 +207,34 @@ def book_filter(filter, field, books):
         except ValueError:
             return Book.objects.none()
 
+    def any_field(filter):
+        course_metabooks = search.course_metabooks(filter)
+        if course_metabooks is None:
+            # a filter without any words matches every course
+            return books
+        # the metabooks are found with subqueries, so however many match
+        # they are never sent back and forth as a list of ids
+        q = Q(metabook__in=search.metabooks(filter)) |\
+            Q(metabook__in=course_metabooks)
+        if isbn(filter):
+            exact = MetaBook.objects.filter(barcode=isbn(filter))
+            q = q | Q(metabook__in=exact)
+        try:
+            number = int(filter)
+            q = q | Q(pk=number) | Q(seller__id=number)
+        except ValueError:
+            pass
+        for choice in Book.STATUS_CHOICES:
+            if filter.lower() in choice[1].lower():
+                q = q | Q(status=choice[0])
+                break
+        # Everything is an indexed lookup on the book table, so no joins
+        # and no need for distinct()
+        return books.filter(q)
+
     if field == "any_field":
+        if indexed and search.grams(filter):
+            return any_field(filter)
         # do all the queries and merge them with the | operator
         # all queries being |'d must be either distinct or non-distinct
         return title(filter).distinct() |\
@@ -121,12 +261,96 @@ def book_filter(filter, field, books):
     else:
         return books
 
+def cached_book_filter(filter, field, staff):
+    """
+    book_filter over all the books (only those for sale if staff is False)
+    which remembers the ids it found until a Book or MetaBook changes.
+    Searches which find more than the cache keeps are left to the database
+    """
+    version = get_version(BOOKS_VERSION)
+    key = (filter.lower(), field, staff)
+    ids = search.results.get(key, version)
+    if ids is not None and ids is not search.TOO_MANY:
+        return Book.objects.filter(id__in=ids)
+    books = book_filter(filter, field, Book.objects.all())
+    if not staff: books = books.filter(status='F')
+    if ids is None:
+        # one more than the cache keeps is enough to tell it's too many
+        limit = search.results.max_results + 1
+        ids = list(books.values_list('id', flat=True)[:limit])
+        search.results.set(key, version, ids)
+        if len(ids) < limit: return Book.objects.filter(id__in=ids)
+    return books
+
+# Sorting through the courses table gives duplicate rows and can't use an
+# index, so sort on the course list stored on the metabook instead
+SORT_ALIASES = {
+    'metabook__courses' : 'metabook__course_list',
+    'courses' : 'course_list',
+}
+
 def book_sort(field, dir):
+    field = SORT_ALIASES.get(field, field)
     if dir == 'desc': dir = '-'
     else: dir = ''
     return Book.objects.order_by("%s%s" % (dir, field))
 
+# This alphabet is the order in which book statuses should be displayed to staff
+STATUS_ORDER = "AFOPMTSD"
+
+def status_rank_sql():
+    """
+    SQL expression giving the position of a book's status in STATUS_ORDER
+    """
+    qn = connection.ops.quote_name
+    column = "%s.%s" % (qn(Book._meta.db_table), qn('status'))
+    whens = ["WHEN '%s' THEN %d" % (s, i) for i, s in enumerate(STATUS_ORDER)]
+    return "CASE %s %s END" % (column, ' '.join(whens))
+
+def status_sort(books):
+    """
+    Orders a Book queryset so the unsold books come first, keeping any
+    ordering already on the queryset as the secondary sort.
+    The ranking is done in the database so that the list can be paginated
+    with LIMIT/OFFSET instead of being pulled into memory
+    """
+    # extra(order_by=...) replaces the existing ordering, so carry it along
+    # and finish on the id so that every page of the list is stable
+    ordering = ['status_rank'] + list(books.query.order_by) + ['id']
+    return books.extra(select={'status_rank' : status_rank_sql()},
+                       order_by=ordering)
+
+class StatusKey(Key):
+    """
+    Cursor pagination key for the staff ordering of book statuses
+    """
+    def __init__(self):
+        Key.__init__(self, 'status')
+
+    def prepare(self, books):
+        return books.extra(select={'status_rank' : status_rank_sql()})
+
+    def ordering(self, reverse=False):
+        if reverse: return '-status_rank'
+        return 'status_rank'
+
+    def beyond(self, value, reverse=False):
+        rank = STATUS_ORDER.index(value)
+        if reverse: return Q(status__in=list(STATUS_ORDER[:rank]))
+        return Q(status__in=list(STATUS_ORDER[rank + 1:]))
+
+def cursor_keys(sort_by, dir, allowed):
+    """
+    Turns the sort_by and dir GET arguments into cursor pagination keys.
+    Returns None if the list can't be cursor paginated by that column
+    """
+    if not sort_by: return []
+    sort_by = SORT_ALIASES.get(sort_by, sort_by)
+    if sort_by not in allowed: return None
+    return [Key(sort_by, dir == 'desc')]
+
 def metabook_sort(field, dir):
+    field = SORT_ALIASES.get(field, field)
     if dir == 'desc': dir = '-'
     else: dir = ''
     return MetaBook.objects.order_by("%s%s" % (dir, field))
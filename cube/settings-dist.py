@@ -103,3 +103,25 @@ AUTHENTICATION_BACKENDS = (
     'cube.twupass.backend.TWUPassBackend',
     'django.contrib.auth.backends.ModelBackend',
 )
+
+# How often, in seconds, the house_cleaning command expires holds and marks
+# year old books as To Be Deleted when it is run with --loop
+HOUSE_CLEANING_INTERVAL = 300
+
+# The send_email command sends queued emails with this many threads, each
+# sending up to EMAIL_BATCH_SIZE emails over one SMTP connection at a time.
+# A failed email is retried after EMAIL_RETRY_DELAY seconds, doubling each
+# time, and given up on after EMAIL_MAX_ATTEMPTS tries
+EMAIL_WORKER_THREADS = 4
+EMAIL_BATCH_SIZE = 50
+EMAIL_RETRY_DELAY = 60
+EMAIL_MAX_ATTEMPTS = 6
+
+# Save up the sold, missing and to be deleted emails and send each seller
+# one digest instead whenever the send_digests command is run, e.g. daily
+EMAIL_DIGEST = False
+
+# Keep a running count of the books with each status so the reports don't
+# have to count them. Run ./manage.py check_status_counts --fix when
+# turning this on
+STATUS_COUNTERS = False
@@ -35,6 +35,8 @@ urlpatterns += patterns('cube.books.views.books',
     url(r'^add_new_book/$', 'add_new_book', name="add_new_book"),
     url(r'^attach_book/$', 'attach_book', name="attach_book"),
     url(r'^my_books/$', 'my_books', name="my_books"),
+    url(r'^books/suggest/$', 'suggest', name="suggest"),
+    url(r'^books/price/$', 'price', name="price"),
 )
 
 urlpatterns += patterns('cube.books.views.reports',
@@ -46,6 +48,7 @@ urlpatterns += patterns('cube.books.views.reports',
     url(r'^reports/book/(\d+)/$', 'book', name='book'),
     url(r'^reports/metabook/(\d+)/$', 'metabook', name='metabook'),
     url(r'^reports/holds_by_user/$', 'holds_by_user', name='holds_by_user'),
+    url(r'^reports/sales_trend/$', 'sales_trend', name='sales_trend'),
 )
 
 urlpatterns += patterns('cube.books.views.metabooks',
@@ -31,3 +31,33 @@ function setCheckboxes(set)
             inputlist[i].checked = set;
     }
 }
+
+// Looks up what copies of the scanned book have sold for and shows the
+// suggested price next to the price box
+function suggestPrice(url)
+{
+    var barcode = document.getElementById("id_barcode");
+    var price = document.getElementById("id_price");
+    if (!barcode || !price || !barcode.value)
+        return;
+    var request = new XMLHttpRequest();
+    request.onreadystatechange = function()
+    {
+        if (request.readyState != 4 || request.status != 200)
+            return;
+        var stats = eval("(" + request.responseText + ")");
+        var help = document.getElementById("id_price_help");
+        if (!help)
+        {
+            help = document.createElement("span");
+            help.id = "id_price_help";
+            help.className = "help_text";
+            price.parentNode.insertBefore(help, price.nextSibling);
+        }
+        help.innerHTML = stats.help ? " " + stats.help : "";
+        if (stats.suggested && !price.value)
+            price.value = stats.suggested;
+    }
+    request.open("GET", url + "?barcode=" + encodeURIComponent(barcode.value), true);
+    request.send(null);
+}